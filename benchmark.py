@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Benchmarks of mintscript: micro-benchmarks of the Python-side functions and
+end-to-end runs over generated corpora, against stub TeX and font tools to
+measure the Python overhead alone, or against the real TeX installation
+'''
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import mintscript
+
+MINTSCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mintscript.py')
+
+# Stand-in of xelatex: writes the aux, log and a one-page PDF (or XDV with
+# -no-pdf) like the real one would, without typesetting anything
+STUB_XELATEX = r'''#!%(python)s
+import os, sys
+args = sys.argv[1:]
+if '--version' in args:
+    print('XeTeX 3.14159265 (mintscript benchmark stub)')
+    sys.exit(0)
+texfile = [a for a in args if a.endswith('.tex')][-1]
+jobname = [a.split('=',1)[1] for a in args if a.startswith('-jobname=')]
+base = jobname[0] if jobname else os.path.splitext(texfile)[0]
+if '-ini' in args:
+    open(base + '.fmt', 'wb').close()
+    sys.exit(0)
+latex = open(texfile).read()
+lines = 0
+for name in os.listdir('.'):
+    if name.startswith('source') and name in latex:
+        with open(name, 'rb') as fp:
+            lines += sum(1 for _ in fp)
+pages = max(1, lines // 80)
+with open(base + '.aux', 'w') as fp:
+    fp.write('\\newlabel{LastPage}{{}{%%d}}\n' %% pages)
+ext = 'xdv' if '-no-pdf' in args else 'pdf'
+with open(base + '.' + ext, 'wb') as fp:
+    fp.write(b'%%PDF-1.4\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n'
+             b'2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n'
+             b'3 0 obj<</Type/Page/Parent 2 0 R/MediaBox[0 0 612 792]>>endobj\n'
+             b'trailer<</Root 1 0 R>>\n%%%%EOF\n')
+with open(base + '.log', 'w') as fp:
+    fp.write('Output written on %%s.%%s (%%d pages, 300 bytes).\n' %% (base, ext, pages))
+'''
+
+# Stand-in of xdvipdfmx: converts the stub XDV by renaming it
+STUB_XDVIPDFMX = r'''#!%(python)s
+import shutil, sys
+args = sys.argv[1:]
+output = args[args.index('-o')+1]
+shutil.copyfile(args[-1], output)
+'''
+
+# Stand-in of fc-match as called by mintscript.fontmatch(): matches any font
+# to an empty file next to the stub, so no font needs to be installed
+STUB_FCMATCH = r'''#!%(python)s
+import os, sys
+name = sys.argv[-1].split(':')[0]
+path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'stubfont.ttf')
+open(path, 'ab').close()
+print('%%s\n0\n%%s\n%%s\n%%s' %% (path, name, name, name.replace(' ', '')))
+'''
+
+# Stand-in of pygmentize as called by minted: copies input to output
+STUB_PYGMENTIZE = r'''#!%(python)s
+import shutil, sys
+args = sys.argv[1:]
+if '-V' in args:
+    print('Pygments (mintscript benchmark stub)')
+    sys.exit(0)
+output = args[args.index('-o')+1] if '-o' in args else None
+if output:
+    shutil.copyfile(args[-1], output)
+'''
+
+SAMPLES = {
+    'txt': lambda rnd, i: '%s INFO worker-%d request %08x served in %d ms\n'
+                          % (time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(i)), rnd.randint(0,31),
+                             rnd.getrandbits(32), rnd.randint(1,999)),
+    'py':  lambda rnd, i: ('def func_%d(x, y=%d):\n' % (i, rnd.randint(0,99)) if i % 5 == 0 else
+                           '    return x * y + %d  # comment %d\n' % (rnd.randint(0,99), i)),
+    'c':   lambda rnd, i: ('int func_%d(int x) {\n' % i if i % 4 == 0 else
+                           '}\n' if i % 4 == 3 else '    x += %d; /* step */\n' % rnd.randint(0,99)),
+}
+
+def makestubs(bindir):
+    '''Write stub xelatex, xdvipdfmx, fc-match and pygmentize into `bindir`
+    '''
+    for name, code in [('xelatex', STUB_XELATEX), ('xdvipdfmx', STUB_XDVIPDFMX)
+                      ,('fc-match', STUB_FCMATCH), ('pygmentize', STUB_PYGMENTIZE)]:
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as fp:
+            fp.write(code % {'python':sys.executable})
+        os.chmod(path, 0o755)
+
+def makecorpus(dirpath, lang, nlines, nfiles, seed=0):
+    '''Generate `nfiles` synthetic source files of `nlines` lines each
+
+    Returns:
+        list of str: paths to the generated files
+    '''
+    rnd = random.Random(seed)
+    paths = []
+    for n in range(nfiles):
+        path = os.path.join(dirpath, 'corpus-%s-%d-%d.%s' % (lang, nlines, n, lang))
+        if not os.path.exists(path):
+            with open(path, 'w') as fp:
+                fp.writelines(SAMPLES[lang](rnd, i) for i in range(nlines))
+        paths.append(path)
+    return paths
+
+def bestof(func, repeat, number):
+    '''Best per-call time of `func` in seconds, as timeit recommends
+    '''
+    return min(timeit.repeat(func, repeat=repeat, number=number)) / number
+
+def microbench(corpusdir, repeat):
+    '''Micro-benchmarks of the Python-side functions of mintscript
+
+    Returns:
+        dict: benchmark name to seconds per call
+    '''
+    path = makecorpus(corpusdir, 'py', 100, 1)[0]
+    argv = ['-E', 'auto', '-C', '-u', 'DRAFT', '--footer', '$n|$D{%Y-%m-%d}|$% of $=', path]
+    args = mintscript.parseargs(argv)
+    options = mintscript.latexoptions(args)
+    files = ['source0.py']
+    results = {
+        'parseargs': bestof(lambda: mintscript.parseargs(argv), repeat, 100),
+        'parseformat': bestof(lambda: mintscript.parseformat('$N|%W %C|$% of $=', [path]), repeat, 100),
+        'latexoptions': bestof(lambda: mintscript.latexoptions(args), repeat, 100),
+        'buildlatex': bestof(lambda: mintscript.buildlatex(options, files), repeat, 1000),
+    }
+    for name, seconds in sorted(results.items()):
+        logging.info('%-24s %10.1f us' % (name, seconds*1e6))
+    return results
+
+def endtoend(corpusdir, repeat, sizes, counts, langs, columns, underlays, extra):
+    '''End-to-end runs of mintscript.py over the combinations of corpus and
+    layout parameters, each with --stats-json for the breakdown into phases
+
+    Returns:
+        list of dict: parameters and timing of each combination
+    '''
+    results = []
+    for nlines, nfiles, lang, ncols, underlay in itertools.product(sizes, counts, langs, columns,
+                                                                    underlays):
+        paths = makecorpus(corpusdir, lang, nlines, nfiles)
+        outdir = tempfile.mkdtemp(prefix='mintscript-bench-')
+        try:
+            statsfile = os.path.join(outdir, 'stats.json')
+            commandline = [sys.executable, MINTSCRIPT, '-q', '--no-cache', '-E', 'auto'
+                          ,'--columns', str(ncols), '--stats-json', statsfile
+                          ,'-o', os.path.join(outdir, 'out.pdf')] + extra + paths
+            if underlay:
+                commandline[2:2] = ['-u', 'BENCHMARK']
+            times, stats = [], None
+            for _ in range(repeat):
+                start = time.time()
+                status = subprocess.call(commandline)
+                times.append(time.time() - start)
+                if status != 0:
+                    logging.error('mintscript failed with return code %s: %s' % (status, commandline))
+                    break
+                with open(statsfile) as fp:
+                    stats = json.load(fp)
+        finally:
+            shutil.rmtree(outdir)
+        result = {'lines':nlines, 'files':nfiles, 'lang':lang, 'columns':ncols
+                 ,'underlay':underlay, 'seconds':min(times), 'stats':stats}
+        logging.info('lines=%-7d files=%-3d lang=%-3s columns=%d underlay=%-5s %8.3f s'
+                     % (nlines, nfiles, lang, ncols, underlay, min(times)))
+        results.append(result)
+    return results
+
+def compare(old, new):
+    '''Print the ratio of timing of two benchmark result files
+    '''
+    for name, seconds in sorted(new['micro'].items()):
+        if name in old.get('micro', {}):
+            print('%-24s %8.2fx' % (name, seconds/old['micro'][name]))
+    keyof = lambda r: (r['lines'], r['files'], r['lang'], r['columns'], r['underlay'])
+    oldruns = {keyof(r):r for r in old.get('endtoend', [])}
+    for run in new['endtoend']:
+        if keyof(run) in oldruns:
+            print('lines=%-7d files=%-3d lang=%-3s columns=%d underlay=%-5s %8.2fx'
+                  % (keyof(run) + (run['seconds']/oldruns[keyof(run)]['seconds'],)))
+
+def parseargs():
+    '''Command line arguments of the benchmark
+
+    Returns:
+        argparse namespace object
+    '''
+    parser = argparse.ArgumentParser(description='benchmark mintscript')
+    parser.add_argument('--real', action='store_true', default=False,
+        help="use the installed xelatex and pygmentize instead of the stubs")
+    parser.add_argument('--repeat', type=int, default=3,
+        help="number of repetitions, the best is reported")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 10000],
+        help="number of lines per file")
+    parser.add_argument('--counts', type=int, nargs='+', default=[1, 8],
+        help="number of files per job")
+    parser.add_argument('--langs', nargs='+', default=['txt', 'py'], choices=sorted(SAMPLES),
+        help="languages of the generated files")
+    parser.add_argument('--columns', type=int, nargs='+', default=[1, 2],
+        help="number of columns")
+    parser.add_argument('--underlays', type=int, nargs='+', default=[0, 1], choices=[0, 1],
+        help="whether to print an underlay")
+    parser.add_argument('--mintscript-args', metavar='ARG', nargs='+', default=[],
+        help="additional arguments for mintscript.py in end-to-end runs")
+    parser.add_argument('--no-micro', action='store_true', default=False,
+        help="skip micro-benchmarks")
+    parser.add_argument('--no-endtoend', action='store_true', default=False,
+        help="skip end-to-end benchmarks")
+    parser.add_argument('--corpus-dir', metavar='DIR',
+        help="keep generated corpus in DIR for reuse")
+    parser.add_argument('-o', '--output', metavar='FILE',
+        help="save results as JSON to FILE")
+    parser.add_argument('--compare', metavar='FILE',
+        help="compare with results saved in FILE")
+    return parser.parse_args()
+
+def main():
+    args = parseargs()
+    logging.getLogger('').setLevel(logging.INFO)
+    corpusdir = args.corpus_dir or tempfile.mkdtemp(prefix='mintscript-corpus-')
+    if not os.path.isdir(corpusdir):
+        os.makedirs(corpusdir)
+    bindir = None
+    if not args.real:
+        bindir = tempfile.mkdtemp(prefix='mintscript-stub-')
+        makestubs(bindir)
+        os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+    elif not shutil.which('xelatex'):
+        logging.error('xelatex not found, run without --real to use the stubs')
+        sys.exit(1)
+    results = {'real':args.real, 'python':platform.python_version(), 'platform':platform.platform()
+              ,'time':time.time(), 'micro':{}, 'endtoend':[]}
+    try:
+        if not args.no_micro:
+            results['micro'] = microbench(corpusdir, args.repeat)
+        if not args.no_endtoend:
+            results['endtoend'] = endtoend(corpusdir, args.repeat, args.sizes, args.counts,
+                                           args.langs, args.columns, args.underlays,
+                                           args.mintscript_args)
+    finally:
+        if bindir:
+            shutil.rmtree(bindir)
+        if not args.corpus_dir:
+            shutil.rmtree(corpusdir)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp), results)
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s:%(levelname)s:%(message)s')
+    main()
+
+# vim:set et sw=4 ts=4:
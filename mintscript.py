@@ -4,24 +4,45 @@
 '''
 
 import argparse
+import array
+import asyncio
+import bisect
+import concurrent.futures
 import contextlib
+import cProfile
+import ctypes
+import ctypes.util
 import datetime
+import fcntl
+import functools
+import hashlib
 import json
 import logging
+import math
+import mmap
 import os
 import pwd
+import queue
 import re
+import select
+import shlex
 import shutil
 import socket
+import socketserver
+import stat
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+import weakref
+import zlib
 
-def parseargs():
+def argparser():
     '''Argument parser that supports a subset of arguments of enscript
 
     Returns:
-        argparse namespace object
+        argparse.ArgumentParser object
     '''
     description = 'convert text files to PDF'
     parser = argparse.ArgumentParser(description=description, add_help=False)
@@ -125,65 +146,335 @@ def parseargs():
         help=r"argument for fontspec \set*font commands")
     parser.add_argument('--minted-args', metavar='OPTION', nargs='+',
         help=r"argument for \inputminted command")
-    args = parser.parse_args()
+    parser.add_argument('--no-cache', action='store_true', default=False,
+        help="do not use the persistent PDF and highlight caches")
+    parser.add_argument('--cache-dir', metavar='DIR',
+        help="directory for persistent caches (default ~/.cache/mintscript)")
+    parser.add_argument('--cache-size', metavar='MB', type=float, default=256,
+        help="size limit of each persistent cache in megabytes")
+    parser.add_argument('--precompile', action='store_true', default=False,
+        help="load the preamble from a cached precompiled format")
+    parser.add_argument('--workdir-root', metavar='DIR',
+        help="create work directories in DIR, e.g. /dev/shm (default is the system temp dir)")
+    parser.add_argument('--workdir-pool', metavar='N', type=int, default=0,
+        help="reuse a pool of N work directories that keep aux files between jobs")
+    parser.add_argument('--workdir-cleanup', choices=['inputs','all'], default='inputs',
+        help="after a job in a pooled work directory, remove only the inputs and outputs "
+             "or all files")
+    parser.add_argument('--highlighter', choices=['minted','pygments'], default='minted',
+        help="highlight with minted through -shell-escape, or with pygments in-process")
+    parser.add_argument('--backend', choices=['latex','native'], default='latex',
+        help="typeset with XeLaTeX, or write plain text PDF directly with the Courier font")
+    parser.add_argument('--pdf-compress', metavar='LEVEL', type=int, choices=range(10),
+        help="compression level 0-9 of the PDF written by xdvipdfmx")
+    parser.add_argument('--pdf-version', choices=['1.3','1.4','1.5','1.6','1.7','2.0'],
+        help="PDF version of the output, 1.5 and later use object streams")
+    parser.add_argument('--jobs', metavar='N', type=int,
+        help="number of parallel workers (default is the number of CPUs)")
+    parser.add_argument('--batch', action='store_true', default=False,
+        help="make one PDF per input file; output, if given, is a directory")
+    parser.add_argument('--manifest', metavar='FILE',
+        help="batch mode with input files listed in FILE, one per line")
+    parser.add_argument('--shard-lines', metavar='NUM', type=int,
+        help="split a large input into chunks of NUM lines compiled in parallel")
+    parser.add_argument('--lines', metavar='RANGES',
+        help="print only lines START:END of each file, several ranges separated by commas, "
+             "e.g. 2000000:2010000,3000000:")
+    parser.add_argument('--bytes', metavar='RANGES',
+        help="print only the lines within byte offsets START:END of each file")
+    parser.add_argument('--line-index', choices=['cache','beside','none'], default='cache',
+        help="keep the line index of files read in ranges in the cache directory, "
+             "next to the file as FILE.lineidx, or not at all")
+    parser.add_argument('--stats-json', metavar='FILE',
+        help="write timing of each phase and xelatex statistics to FILE as JSON")
+    parser.add_argument('--profile', metavar='FILE',
+        help="write cProfile statistics of the run to FILE")
+    parser.add_argument('--watch', action='store_true', default=False,
+        help="render again whenever an input file changes, until interrupted")
+    parser.add_argument('--watch-interval', metavar='SEC', type=float, default=1.0,
+        help="polling interval of --watch where inotify is not available")
+    parser.add_argument('--serve', metavar='SOCKET',
+        help="run as a render daemon accepting jobs at Unix socket SOCKET")
+    parser.add_argument('--client', metavar='SOCKET',
+        help="send the job to the render daemon at Unix socket SOCKET")
+    return parser
+
+def parseargs(argv=None):
+    '''Parse command line arguments, print help and exit if requested
+
+    Args:
+        argv (list of str): arguments to parse, default is sys.argv[1:]
+
+    Returns:
+        argparse namespace object
+    '''
+    parser = argparser()
+    args = parser.parse_args(argv)
     if args.help:
         parser.print_help()
         sys.exit(1)
     return args
 
-def parseformat(formatstr, inputfile=None):
-    '''convert format string into format understood by fancyhdr. This is
+@functools.lru_cache(maxsize=None)
+def argdefaults():
+    '''Default values of all arguments, by parsing an empty command line once
+    '''
+    return vars(argparser().parse_args([]))
+
+@functools.lru_cache(maxsize=None)
+def argactions():
+    '''Arguments of argparser() grouped by their `dest`, built once
+    '''
+    actions = {}
+    for action in argparser()._actions:
+        actions.setdefault(action.dest, []).append(action)
+    return actions
+
+def optionvalue(actions, name, value):
+    '''Check the value of an option given without a command line against the
+    `type`, `nargs` and `choices` of its arguments, as argparse would. A string
+    is converted by `type`, any other value must already be of that type
+
+    Args:
+        actions (list): argparse actions of the option, i.e. with `name` as dest
+        name (str): the option name
+        value: the option value
+
+    Returns:
+        the value, converted if given as a string
+
+    Raises:
+        ValueError: if no argument of the option accepts the value
+    '''
+    for action in actions:
+        if isinstance(action, (argparse._StoreTrueAction, argparse._StoreFalseAction)):
+            if isinstance(value, bool):
+                return value
+            continue
+        if isinstance(action, argparse._StoreConstAction):
+            if value == action.const and type(value) is type(action.const):
+                return value
+            continue
+        if not isinstance(action, argparse._StoreAction):
+            return value # no other kind in argparser()
+        if value is None and action.default is None or action.nargs == '?' and value == action.const:
+            return value
+        multiple = action.nargs in ('*', '+') or isinstance(action.nargs, int)
+        items = value if multiple else [value]
+        if multiple and (not isinstance(value, (list, tuple))
+                         or isinstance(action.nargs, int) and len(value) != action.nargs
+                         or action.nargs == '+' and not value):
+            continue
+        converted = []
+        for item in items:
+            if isinstance(item, str) and action.type not in (None, bool):
+                try:
+                    item = action.type(item)
+                except (TypeError, ValueError):
+                    break
+            elif action.type is float and isinstance(item, int) and not isinstance(item, bool):
+                item = float(item)
+            if not isinstance(item, action.type or str) \
+                    or isinstance(item, bool) != (action.type is bool):
+                break
+            if action.choices is not None and item not in action.choices:
+                break
+            converted.append(item)
+        else:
+            return list(converted) if multiple else converted[0]
+    choices = [a.choices for a in actions if getattr(a, 'choices', None) is not None]
+    raise ValueError('invalid value for option %s: %r%s'
+                     % (name, value, ' (choose from %s)' % ', '.join(map(str, choices[0]))
+                                     if choices else ''))
+
+def jobargs(**options):
+    '''Build the arguments of a job without a command line, for use as a
+    library. Options are named as the `dest` of the command line arguments,
+    e.g. `columns=2`, `landscape=True`, `header='$n|$%|%W'`
+
+    Returns:
+        argparse namespace object
+
+    Raises:
+        TypeError: if an option is unknown
+        ValueError: if the value of an option is invalid, see optionvalue()
+    '''
+    defaults = argdefaults()
+    unknown = sorted(set(options) - set(defaults))
+    if unknown:
+        raise TypeError('unknown option: %s' % ', '.join(unknown))
+    options = {name:optionvalue(argactions()[name], name, value) for name, value in options.items()}
+    args = argparse.Namespace(**dict(defaults, **options))
+    if args.file is defaults['file']:
+        args.file = [] # not to share the cached list
+    return args
+
+# escapes in header and footer format strings, see compileformat()
+FORMATESCAPE = re.compile(r'\$\((\w+)\)|\$D\{([^\}]+)\}|\$[%=C*tTDEFWnN$]|%[*CtTDEFWcdmMnNv%]')
+
+# aliases of escapes, resolved into the key of FORMATFIELDS
+FORMATALIASES = {'$C':'%C', '$*':'%C', '%*':'%C', '$t':'%t', '$T':'%T', '$D':'%D', '$E':'%E',
+                 '$F':'%F', '$W':'%W'}
+
+# escapes with value depending on the input file: name, sequence number, and
+# time, which is the modification time of the file
+FORMATPERFILE = {'$n', '$N', '%v', '$D{', '%C', '%t', '%T', '%D', '%E', '%F', '%W'}
+
+@functools.lru_cache(maxsize=None)
+def hostname(fqdn=False):
+    '''Host name, cached as getfqdn() may block on DNS lookup'''
+    return socket.getfqdn() if fqdn else socket.gethostname()
+
+@functools.lru_cache(maxsize=None)
+def userinfo():
+    '''Password database entry of the current user, cached'''
+    return pwd.getpwuid(os.getuid())
+
+def formattime(ctx):
+    '''Time for the time escapes: modification time of the input file, or now
+    for stdin or no input. Looked up on first use and kept in `ctx`. A
+    missing file also gives now, the job reports it when staging the input
+    '''
+    if 'time' not in ctx:
+        path = ctx.get('path')
+        try:
+            mtime = os.stat(path).st_mtime if path and path != '-' else None
+        except OSError:
+            mtime = None
+        ctx['time'] = datetime.datetime.now() if mtime is None else datetime.datetime.fromtimestamp(mtime)
+    return ctx['time']
+
+FORMATFIELDS = {
+    '$%': lambda ctx, arg: r'\thepage{}',
+    '$=': lambda ctx, arg: r'\pageref{LastPage}', # need LastPage label
+    '$(': lambda ctx, arg: (os.environ if ctx.get('environ') is None else ctx['environ'])[arg],
+    '$D{': lambda ctx, arg: formattime(ctx).strftime(arg),
+    '%C': lambda ctx, arg: formattime(ctx).strftime('%H:%M:%S'),
+    '%t': lambda ctx, arg: formattime(ctx).strftime('%I:%M %p'),
+    '%T': lambda ctx, arg: formattime(ctx).strftime('%H:%M'),
+    '%D': lambda ctx, arg: formattime(ctx).strftime('%y-%m-%d'),
+    '%E': lambda ctx, arg: formattime(ctx).strftime('%y/%m/%d'),
+    '%F': lambda ctx, arg: formattime(ctx).strftime('%d.%m.%Y'),
+    '%W': lambda ctx, arg: formattime(ctx).strftime('%m/%d/%y'),
+    '%c': lambda ctx, arg: os.path.split(ctx.get('cwd') or os.getcwd())[-1],
+    '%d': lambda ctx, arg: ctx.get('cwd') or os.getcwd(),
+    '%m': lambda ctx, arg: hostname(),
+    '%M': lambda ctx, arg: hostname(fqdn=True),
+    '%n': lambda ctx, arg: userinfo().pw_name,
+    '%N': lambda ctx, arg: userinfo().pw_gecos,
+    '$n': lambda ctx, arg: os.path.basename(ctx['name'].replace('_','\\_')) if ctx.get('name') else '',
+    '$N': lambda ctx, arg: ctx['name'].replace('_','\\_') if ctx.get('name') else '',
+    '%v': lambda ctx, arg: str(ctx.get('index', 1)),
+    '$$': lambda ctx, arg: '$',
+    '%%': lambda ctx, arg: '%',
+}
+
+@functools.lru_cache(maxsize=256)
+def compileformat(formatstr):
+    '''Parse a format string once into a template for renderformat(). This is
     different from enscript's %Format that width, such as $5% for page number in
     5 character spaces, is not supported
 
     Args:
         formatstr (str): format string input with escapes
-        inputfile (str): filename input, in case file-dependent info are used
 
     Returns:
-        str or list of three str: the formatted field, or left, center, and
-        right part of the fields in case `|` in the format string
+        tuple: literal text as str and escapes as (key, arg) tuples, or a list
+        of three such templates for left, center, and right part of the fields
+        in case `|` in the format string. Shared by all callers, do not modify
     '''
     if '|' in formatstr:
         # left, center, and right justified fields
         fields = formatstr.split('|')
         assert(len(fields) == 3)
-        fields = [parseformat(f, inputfile) for f in fields]
-        return fields
-    cwd = os.getcwd()
-    cwdtrail = os.path.split(os.getcwd())[-1]
-    if inputfile:
-        inputfile = inputfile[0]
-        now = datetime.datetime.fromtimestamp(os.stat(inputfile).st_mtime)
-    else:
-        now = datetime.datetime.now()
-    formatstr = re.sub(r'\$\((\w+)\)', lambda m:os.environ[m.group(1)],formatstr)
-    formatstr = re.sub(r'\$D\{([^\}]+)\}', lambda m:now.strftime(m.group(1)),formatstr)
-    formatstr = ( formatstr
-                 .replace('$%',r'\thepage{}')
-                 .replace('$=',r'\pageref{LastPage}') # need LastPage label
-                 .replace('$C','%C').replace('$*','%C').replace('%*','%C')
-                                    .replace('%C',now.strftime('%H:%M:%S'))
-                 .replace('$t','%t').replace('%t',now.strftime('%I:%M %p'))
-                 .replace('$T','%T').replace('%T',now.strftime('%H:%M'))
-                 .replace('$D','%D').replace('%D',now.strftime('%y-%m-%d'))
-                 .replace('$E','%E').replace('%E',now.strftime('%y/%m/%d'))
-                 .replace('$F','%F').replace('%F',now.strftime('%d.%m.%Y'))
-                 .replace('$W','%W').replace('%W',now.strftime('%m/%d/%y'))
-                 .replace('%c',cwdtrail)
-                 .replace('%d',cwd)
-                 .replace('%m',socket.gethostname())
-                 .replace('%M',socket.getfqdn())
-                 .replace('%n',pwd.getpwuid(os.getuid()).pw_name)
-                 .replace('$n',os.path.basename(inputfile.replace('_','\\_')) if inputfile else '')
-                 .replace('%N',pwd.getpwuid(os.getuid()).pw_gecos)
-                 .replace('$N',inputfile.replace('_','\\_') if inputfile else '')
-                 .replace('$$','$')
-                 .replace('%%','%')
-                )
-    # TODO %v for sequence number of input file (in case of multiple file input)
-    #      rewrite above to get filename/mtime dynamically in case of multi-file input
-    return formatstr
+        return [compileformat(f) for f in fields]
+    template, pos = [], 0
+    for m in FORMATESCAPE.finditer(formatstr):
+        if m.start() > pos:
+            template.append(formatstr[pos:m.start()])
+        if m.group(1):
+            template.append(('$(', m.group(1)))
+        elif m.group(2):
+            template.append(('$D{', m.group(2)))
+        else:
+            template.append((FORMATALIASES.get(m.group(0), m.group(0)), None))
+        pos = m.end()
+    if pos < len(formatstr):
+        template.append(formatstr[pos:])
+    return tuple(template)
+
+def formatcontext(path=None, name=None, index=1, origin=None):
+    '''Context of rendering a format for an input file
+
+    Args:
+        path (str): path to the input file for its modification time, or `-`
+        name (str): file name to print, defaults to `path`
+        index (int): sequence number of the file in the job, from 1
+        origin (dict): `cwd` and `environ` of the process that submitted the
+                       job, defaults to those of this process
+    '''
+    if name is None and path:
+        name = 'stdin' if path == '-' else path
+    return dict(origin or {}, path=path, name=name, index=index)
+
+def renderformat(template, ctx, perfile=None):
+    '''Render a template of compileformat() into a string for fancyhdr. Values
+    are looked up only for escapes used in the template
+
+    Args:
+        template (tuple): output of compileformat()
+        ctx (dict): output of formatcontext()
+        perfile (dict): if provided, escapes depending on the input file are
+                        rendered as macros instead, and added to this dict of
+                        (key, arg) to macro name
+
+    Returns:
+        str or list of three str
+    '''
+    if isinstance(template, list):
+        return [renderformat(t, ctx, perfile) for t in template]
+    ret = []
+    for token in template:
+        if isinstance(token, str):
+            ret.append(token)
+        elif perfile is not None and token[0] in FORMATPERFILE:
+            if token not in perfile:
+                perfile[token] = r'\mintscriptfield' + ''.join(chr(ord('a')+int(d)) for d in str(len(perfile)))
+            ret.append(perfile[token] + '{}')
+        else:
+            ret.append(FORMATFIELDS[token[0]](ctx, token[1]))
+    return ''.join(ret)
+
+def parseformat(formatstr, inputfile=None):
+    '''convert format string into format understood by fancyhdr, using the
+    first input file for file-dependent info
+
+    Args:
+        formatstr (str): format string input with escapes
+        inputfile (list of str): filename input, in case file-dependent info are used
+
+    Returns:
+        str or list of three str: the formatted field, or left, center, and
+        right part of the fields in case `|` in the format string
+    '''
+    ctx = formatcontext(inputfile[0] if inputfile else None)
+    return renderformat(compileformat(formatstr), ctx)
+
+def formatenviron(formats):
+    '''Environment variables of the `$(VAR)` escapes in format strings, which
+    the render daemon resolves from the client's environment
+
+    Returns:
+        dict: variable name to value, for those set
+    '''
+    environ = {}
+    for formatstr in filter(None, formats):
+        template = compileformat(formatstr)
+        for part in template if isinstance(template, list) else [template]:
+            for token in part:
+                if isinstance(token, tuple) and token[0] == '$(' and token[1] in os.environ:
+                    environ[token[1]] = os.environ[token[1]]
+    return environ
 
 def parsefont(fontstr):
     '''Convert font string into font and size if possible. Allowed format:
@@ -224,6 +515,162 @@ def parsefont(fontstr):
         pass # pass as-is if cannot parse
     return font, size
 
+FONTS = {} # in-process memo of resolvefont(), kept warm by the render daemon
+FONTLOCK = threading.Lock()
+
+# fontspec options of the faces of a font loaded by file, with their fontconfig style
+FONTFACES = [('BoldFont', 'bold'), ('ItalicFont', 'italic'), ('BoldItalicFont', 'bold:italic')]
+
+def fontmatch(name, style=None):
+    '''Locate the file of a font by fontconfig. The font found must have
+    `name` as its family, full name or PostScript name, as fc-match otherwise
+    returns a fallback font
+
+    Args:
+        name (str): font name
+        style (str): fontconfig style properties, e.g. `bold:italic`
+
+    Returns:
+        dict: with keys `path`, `index` (in a font collection), `size` and
+        `mtime` of the font file, or None if fontconfig is not available
+
+    Raises:
+        RuntimeError: if the font is not found
+    '''
+    try:
+        output = subprocess.check_output(['fc-match', '--format=%{file}\n%{index}\n%{family}\n'
+                                          '%{fullname}\n%{postscriptname}\n',
+                                          name + (':' + style if style else '')],
+                                         stderr=subprocess.DEVNULL)
+    except OSError:
+        return None # no fontconfig, leave the lookup to xelatex
+    except subprocess.CalledProcessError:
+        raise RuntimeError('Font %s not found' % name)
+    fields = output.decode('utf-8', 'replace').split('\n') + ['']
+    path, index, names = fields[0], fields[1], ','.join(fields[2:])
+    canonical = lambda s: s.replace(' ', '').replace('-', '').lower()
+    if canonical(name) not in [canonical(n) for n in names.split(',') if n] or not os.path.isfile(path):
+        raise RuntimeError('Font %s not found, closest match is %s' % (name, names.split(',')[0] or path))
+    st = os.stat(path)
+    return {'path':path, 'index':int(index or 0), 'size':st.st_size, 'mtime':st.st_mtime}
+
+def fontfaces(name, regular):
+    '''Files of the bold, italic and bold italic faces of font `name`, which
+    fontspec finds by itself only when the font is loaded by name. A face that
+    fontconfig resolves to the `regular` file does not exist
+
+    Returns:
+        dict: fontspec option of the face, e.g. `BoldFont`, to the output of
+        fontmatch()
+    '''
+    faces = {}
+    for option, style in FONTFACES:
+        try:
+            entry = fontmatch(name, style)
+        except RuntimeError:
+            continue
+        if entry and (entry['path'], entry['index']) != (regular['path'], regular['index']):
+            faces[option] = entry
+    return faces
+
+def fontvalid(entry):
+    '''Whether the font files of a resolvefont() result are unchanged'''
+    for font in [entry] + list(entry.get('faces', {}).values()):
+        try:
+            st = os.stat(font['path'])
+        except OSError:
+            return False
+        if (st.st_size, st.st_mtime) != (font['size'], font['mtime']):
+            return False
+    return 'faces' in entry # cached before faces were resolved
+
+@contextlib.contextmanager
+def filelock(path):
+    '''a context manager to hold an exclusive flock on file `path`, to
+    serialize processes; does nothing if `path` is None
+    '''
+    if path is None:
+        yield
+        return
+    with open(path, 'a') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        yield
+
+def resolvefont(name, cachefile=None):
+    '''Map a font name to its file once, such that fontspec loads the file by
+    path without a name lookup, together with its bold and italic faces.
+    Results are memoized in-process and in `cachefile` across runs, and
+    looked up again if a font file changed. The cache file is updated under a
+    file lock, as processes and threads of the render daemon share it
+
+    Args:
+        name (str): font name as given to fontspec, or path to a font file
+        cachefile (str): path to the persistent JSON cache, or None
+
+    Returns:
+        dict: output of fontmatch() with key `faces` from fontfaces(), or
+        None if the font cannot be resolved to a file and xelatex should look
+        it up by name
+
+    Raises:
+        RuntimeError: if the font is not found
+    '''
+    if os.path.isfile(name): # font file given
+        st = os.stat(name)
+        return {'path':os.path.abspath(name), 'index':0, 'size':st.st_size, 'mtime':st.st_mtime}
+    entry = FONTS.get(name)
+    if entry and fontvalid(entry):
+        return entry
+    with FONTLOCK, filelock(cachefile and cachefile + '.lock'):
+        cache = {}
+        if cachefile:
+            try:
+                with open(cachefile) as fp:
+                    cache = json.load(fp)
+            except (IOError, OSError, ValueError):
+                pass # no cache yet or corrupted, start over
+        entry = cache.get(name)
+        if not (entry and fontvalid(entry)):
+            logging.debug('Resolve font %s by fontconfig' % name)
+            entry = fontmatch(name)
+            if entry is None:
+                return None
+            entry['faces'] = fontfaces(name, entry)
+            cache[name] = entry
+            if cachefile:
+                fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(cachefile), prefix='.tmp-')
+                with os.fdopen(fd, 'w') as fp:
+                    json.dump(cache, fp, indent=2, sort_keys=True)
+                os.replace(tmppath, cachefile)
+        FONTS[name] = entry
+    logging.debug('Font %s is %s' % (name, entry['path']))
+    return entry
+
+def fontspecfont(opt, name, fontargs=()):
+    '''fontspec options and font argument of a font command for font `name`,
+    by file path if resolvefont() found it, e.g.
+    `[Path=/usr/share/fonts/,BoldFont=Inconsolata-Bold.ttf,AutoFakeSlant]{Inconsolata-Regular.ttf}`.
+    AutoFakeBold and AutoFakeSlant are dropped where the real face exists. If
+    the faces are in different directories, the font is loaded by name
+    '''
+    entry = (opt.get('fontfiles') or {}).get(name)
+    fontargs = list(fontargs)
+    faces = (entry or {}).get('faces') or {}
+    if entry and all(os.path.dirname(f['path']) == os.path.dirname(entry['path'])
+                     for f in faces.values()):
+        dirpath, name = os.path.split(entry['path'])
+        faceargs = []
+        for option, _ in FONTFACES:
+            if option in faces:
+                faceargs.append('%s=%s' % (option, os.path.basename(faces[option]['path'])))
+                if faces[option]['index']:
+                    faceargs.append('%sFeatures={FontIndex=%d}' % (option[:-4], faces[option]['index']))
+        fontargs = [a for a in fontargs if not (a == 'AutoFakeBold' and 'BoldFont' in faces
+                                                or a == 'AutoFakeSlant' and 'ItalicFont' in faces)]
+        fontargs = ['Path=%s/' % dirpath] + (['FontIndex=%d' % entry['index']] if entry['index'] else []) \
+                   + faceargs + fontargs
+    return ('[%s]{%s}' if fontargs else '%s{%s}') % (','.join(fontargs), name)
+
 def latexoptions(args):
     '''Convert command line options parsed by argparse into LaTeX packages'
     options. I/O related arguments are handled elsewhere.
@@ -237,7 +684,9 @@ def latexoptions(args):
     ret = {'input':args.file, 'geometry':['xetex'], 'minted':[], 'mintedlang':'text'
           ,'mintedstyle':'autumn', 'font':('Inconsolata','8pt'), 'multicols':None
           ,'header_font':('Inconsolata','8pt'), 'header':None, 'footer':None
-          ,'fontspec_args':['AutoFakeSlant','AutoFakeBold']}
+          ,'fontspec_args':['AutoFakeSlant','AutoFakeBold'], 'autolang':False
+          ,'highlighter':args.highlighter, 'backend':args.backend
+          ,'pdf_compress':args.pdf_compress, 'pdf_version':args.pdf_version}
     if args.columns==1:
         ret['geometry'].append('onecolumn')
     elif args.columns==2:
@@ -253,6 +702,7 @@ def latexoptions(args):
     if args.highlight is not None:
         highlight = args.highlight.lower()
         if highlight == 'auto':
+            ret['autolang'] = True # detect per file, default from the first file
             highlight = os.path.splitext(args.file[0])[1][1:]
         if highlight == 'python3':
             ret['minted'].append('python3')
@@ -309,12 +759,7 @@ def latexoptions(args):
             ret['minted'].append(r'breaksymbolright=\small\carriagereturn')
         elif args.mark_wrapped_lines != 'none':
             ret['minted'].append(r'breaksymbolright=\small%s' % args.mark_wrapped_lines)
-    if args.footer:
-        ret['footer'] = parseformat(args.footer, args.file)
-    if args.header:
-        ret['header'] = parseformat(args.header, args.file)
-    elif not args.no_header:
-        ret['header'] = parseformat("$N\t$D{%c}\t$%", args.file)
+    ret.update(headeroptions(args, args.file))
     if args.header_font: # also use as footer font
         ret['header_font'] = parsefont(args.header_font)
     if args.underlay:
@@ -337,44 +782,269 @@ def latexoptions(args):
             ret['underlay']['style'] = args.ul_style
     if args.no_job_header or args.toc:
         raise NotImplementedError
+    if args.backend == 'latex': # fail fast on missing fonts, before running xelatex
+        fontcache = None if args.no_cache else os.path.join(cachedir('fonts', args.cache_dir),
+                                                            'fonts.json')
+        names = [ret['font'][0], ret['header_font'][0], ret.get('underlay', {}).get('font', [None])[0]]
+        ret['fontfiles'] = {}
+        for name in sorted(set(filter(None, names))):
+            entry = resolvefont(name, fontcache)
+            if entry:
+                ret['fontfiles'][name] = entry
+    return ret
+
+def mintedlang(opt, filename):
+    '''Language for minted to highlight a file. With `-E auto`, it is
+    derived from the file extension of each file
+    '''
+    if opt.get('autolang'):
+        ext = os.path.splitext(filename)[1][1:].lower()
+        return 'python' if ext == 'python3' else (ext or 'text')
+    return opt['mintedlang']
+
+def firstnumber(mintedopts):
+    '''Number of the first line as set by `firstnumber` of minted, default 1
+    '''
+    base = [int(o.split('=',1)[1]) for o in mintedopts if o.startswith('firstnumber=')]
+    return base[-1] if base else 1
+
+def partminted(opt, index):
+    '''minted options of the `index`-th file of the document. A part cut out
+    of a file by selectranges() is numbered from its line in the file
+    '''
+    ranges = opt.get('ranges')
+    if ranges and ranges[index] and 'linenos' in opt['minted']:
+        return opt['minted'] + ['firstnumber=%d' % (firstnumber(opt['minted']) + ranges[index][0] - 1)]
+    return opt['minted']
+
+def fvextraoptions(mintedopts):
+    '''Translate \\inputminted options into fvextra's \\VerbatimInput options.
+    Options that affect highlighting are consumed by pygments instead
+    '''
+    fvopts = []
+    for opt in mintedopts:
+        name = opt.split('=',1)[0]
+        if name == 'linenos':
+            fvopts.append('numbers=left')
+        elif name in ('python3', 'encoding', 'tabsize'):
+            continue # handled by pygments lexer, see highlightfile()
+        else:
+            fvopts.append(opt)
+    return fvopts
+
+def pygmentsstyle(style):
+    '''LaTeX macros of a pygments style, for the markup made by highlightfile()
+    '''
+    from pygments.formatters import LatexFormatter
+    return LatexFormatter(style=style or 'default', commandprefix='PYG').get_style_defs()
+
+def highlightfile(srcpath, dstpath, lang, filename, mintedopts, hlcache=None):
+    '''Highlight a source file into pygments' LaTeX markup for fvextra's
+    \\VerbatimInput with commandchars. This runs in worker processes
+
+    Args:
+        srcpath (str): path to the source file
+        dstpath (str): path to write the LaTeX markup
+        lang (str): lexer name, or None to detect from filename and content
+        filename (str): original filename, for lexer detection
+        mintedopts (list): minted options, for the lexer options in them
+        hlcache (str): highlight cache directory shared across runs, or None
+
+    Returns:
+        bool: whether the markup is reused from the highlight cache
+    '''
+    import pygments
+    from pygments import highlight
+    from pygments.formatters import LatexFormatter
+    from pygments.lexers import get_lexer_by_name, get_lexer_for_filename, guess_lexer
+    from pygments.util import ClassNotFound
+    lexeropts = {'encoding':'guess'}
+    for opt in mintedopts:
+        name, _, value = opt.partition('=')
+        if name == 'tabsize':
+            lexeropts['tabsize'] = int(value)
+        elif name == 'encoding':
+            lexeropts['encoding'] = value
+    with open(srcpath, 'rb') as fp:
+        code = fp.read()
+    try:
+        if lang:
+            lexer = get_lexer_by_name(lang, **lexeropts)
+        else:
+            try:
+                lexer = get_lexer_for_filename(filename, code, **lexeropts)
+            except ClassNotFound:
+                lexer = guess_lexer(code, **lexeropts)
+    except ClassNotFound:
+        lexer = get_lexer_by_name('text', **lexeropts)
+    if hlcache:
+        # markup of nowrap formatter does not depend on style, hence not in key
+        digest = hashlib.sha256(code)
+        digest.update(json.dumps([pygments.__version__, type(lexer).__name__,
+                                  lexeropts, sorted(mintedopts)]).encode('utf-8'))
+        key = digest.hexdigest()
+        cached = cachelookup(hlcache, key, '.pyg')
+        if cached:
+            try:
+                shutil.copyfile(cached, dstpath)
+                logging.debug('Highlight cache hit: %s' % filename)
+                return True
+            except (IOError, OSError):
+                pass # evicted by a concurrent process
+    logging.debug('Highlight %s with lexer %s' % (filename, lexer.name))
+    formatter = LatexFormatter(nowrap=True, commandprefix='PYG')
+    with open(dstpath, 'w', encoding='utf-8') as fp:
+        highlight(code, lexer, formatter, fp)
+    if hlcache:
+        cachestore(hlcache, key, '.pyg', dstpath, None)
+    return False
+
+def highlightinputs(opt, inputfiles, filenames, jobs=None, hlcache=None, maxbytes=None,
+                    workdir='', pool=None):
+    '''Highlight the staged input files in-process with pygments, spreading
+    the files across a pool of worker processes. Output of file `f` is `f.pyg`
+
+    Args:
+        opt (dict): output of latexoptions()
+        inputfiles (list of str): original file names, for lexer detection
+        filenames (list of str): staged files in the working directory
+        jobs (int): number of worker processes, default is number of CPUs
+        hlcache (str): highlight cache directory shared across runs, or None
+        maxbytes (int): size limit of the highlight cache
+        workdir (str): the working directory, default is the current directory
+        pool (concurrent.futures.Executor): long-lived worker pool to use
+            instead of creating one for this call
+    '''
+    lang = None if opt['autolang'] else opt['mintedlang']
+    tasks = [(os.path.join(workdir, f), os.path.join(workdir, f+'.pyg'), lang, orig,
+              opt['minted'], hlcache)
+             for orig, f in zip(inputfiles, filenames)]
+    jobs = min(jobs or os.cpu_count() or 1, len(tasks))
+    if pool is not None and len(tasks) > 1:
+        hits = [future.result() for future in [pool.submit(highlightfile, *task) for task in tasks]]
+    elif jobs <= 1:
+        hits = [highlightfile(*task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(highlightfile, *task) for task in tasks]
+            hits = [future.result() for future in futures] # propagate exceptions
+    if hlcache:
+        logging.info('Highlight cache: %d hit(s), %d miss(es)' % (sum(hits), len(hits)-sum(hits)))
+        if maxbytes is not None:
+            cacheprune(hlcache, maxbytes)
+
+def latexcommand(opt, texfile, quiet=False):
+    '''Command line to run xelatex on the generated document. -shell-escape is
+    only needed when minted runs pygmentize
+    '''
+    if quiet:
+        commandline = ['xelatex','-interaction=batchmode','-8bit','-no-pdf',texfile]
+    else:
+        commandline = ['xelatex','-8bit','-interaction=nonstopmode','-halt-on-error','-no-pdf',
+                       texfile]
+    if opt.get('highlighter') != 'pygments':
+        commandline.insert(1, '-shell-escape')
+    return commandline
+
+def pdfcommand(opt, texfile, quiet=False):
+    '''Command line of the PDF driver to convert the XDV file of the last
+    xelatex pass, see latexcommand(), into the PDF. PDF version 1.5 and later
+    allow xdvipdfmx to pack objects into object streams
+    '''
+    base = os.path.splitext(texfile)[0]
+    commandline = ['xdvipdfmx']
+    if quiet:
+        commandline.append('-q')
+    if opt.get('pdf_compress') is not None:
+        commandline.extend(['-z', str(opt['pdf_compress'])])
+    if opt.get('pdf_version'): # -V takes the minor version of PDF 1.x
+        version = opt['pdf_version']
+        commandline.extend(['-V', version[2:] if version.startswith('1.') else version])
+    return commandline + ['-o', base + '.pdf', base + '.xdv']
+
+ENDOFDUMP = r'\csname endofdump\endcsname' # mylatexformat marker, no-op otherwise
+
+def headeroptions(args, inputfile, names=None):
+    '''Header and footer part of latexoptions(), which depends on the input
+    files. Batch mode reuses the other options and calls this for each file.
+    With multiple input files, the file-dependent escapes are rendered as
+    macros, which buildlatex() redefines before each file
+
+    Args:
+        args: argparse namespace object
+        inputfile (list of str): input files of the job
+        names (list of str): file names to print instead of `inputfile`
+
+    Returns:
+        dict: with keys `header`, `footer`, and `filefields` as list of
+        (macro, value) pairs for each input file, or None
+    '''
+    ret = {'header':None, 'footer':None, 'filefields':None}
+    formats = {'footer':args.footer, 'header':args.header}
+    if not args.header and not args.no_header:
+        formats['header'] = "$N\t$D{%c}\t$%"
+    inputfile = inputfile or []
+    origin = getattr(args, 'origin', None) # of the client, set by the render daemon
+    contexts = [formatcontext(f, names[i] if names else None, i+1, origin)
+                for i,f in enumerate(inputfile)]
+    perfile = {} if len(contexts) > 1 else None
+    for hf, formatstr in formats.items():
+        if formatstr:
+            ret[hf] = renderformat(compileformat(formatstr),
+                                   contexts[0] if contexts else formatcontext(origin=origin), perfile)
+    if perfile:
+        ret['filefields'] = [[(macro, FORMATFIELDS[key](ctx, arg))
+                              for (key, arg), macro in perfile.items()]
+                             for ctx in contexts]
     return ret
 
 def buildlatex(opt, filenames):
     '''Generate latex code
     '''
-    fontspecargs = ','.join(opt['fontspec_args'])
+    fancy = opt['header'] or opt['footer'] or 'underlay' in opt
+    pygmentize = opt.get('highlighter') == 'pygments'
     preamble = [''
        ,r'\documentclass{article}'
        ,r'\usepackage[%s]{geometry}' % ','.join(opt['geometry'])
        ,r'\usepackage{amssymb}' # for symbols at line wrapping, just in case
-       ,r'\usepackage{fontspec}'
-       ,r'\usepackage{minted}'
-       ,r'\usemintedstyle{%s}'%opt['mintedstyle'] if opt['mintedstyle'] else None
     ]+([''
-       ,r'\setmonofont[%(a)s]{%(f)s}' % {'a':fontspecargs,'f':opt['font'][0]}
-       ,r'\setsansfont[%(a)s]{%(f)s}' % {'a':fontspecargs,'f':opt['font'][0]}
-       ,r'\setmainfont[%(a)s]{%(f)s}' % {'a':fontspecargs,'f':opt['font'][0]}
-    ] if opt['font'][0] else [])+([''
+       ,r'\usepackage{fvextra}'
+       ,r'\usepackage{xcolor}'
+    ] if pygmentize else [''
+       ,r'\usepackage{minted}'
+    ])+([''
        ,r'\usepackage{tikz}'
        ,r'\usepackage{tikzpagenodes}'
        ,r'\usetikzlibrary{calc}'
+    ] if 'underlay' in opt else [])+([''
+       ,r'\usepackage{multicol}'
+    ] if opt['multicols'] else [])+([''
+       ,r'\usepackage{fancyhdr}'
+    ] if fancy else [])+[''
+       ,ENDOFDUMP # packages above can be precompiled, native fonts cannot
+       ,r'\usepackage{fontspec}'
+       ,r'\usemintedstyle{%s}'%opt['mintedstyle'] if opt['mintedstyle'] and not pygmentize else None
+       ,pygmentsstyle(opt['mintedstyle']) if pygmentize else None
+    ]+([''
+       ,r'\setmonofont' + fontspecfont(opt, opt['font'][0], opt['fontspec_args'])
+       ,r'\setsansfont' + fontspecfont(opt, opt['font'][0], opt['fontspec_args'])
+       ,r'\setmainfont' + fontspecfont(opt, opt['font'][0], opt['fontspec_args'])
+    ] if opt['font'][0] else [])+([''
        ,r'\makeatletter' # https://tex.stackexchange.com/questions/165929/semiverbatim-with-tikz-in-beamer/165937#165937
        ,r'\global\let\tikz@ensure@dollar@catcode=\relax'
        ,r'\makeatother'
     ] if 'underlay' in opt else [])+([''
-        r'\usepackage{multicol}'
        ,r'\setlength{\columnsep}{5mm}'
     ] if opt['multicols'] else [])
 
     lh,ch,rh,lf,cf,rf = range(6)
     headfoot = ['']*6
-    if not opt['header'] and not opt['footer'] and 'underlay' not in opt:
+    if not fancy:
         preamble.extend([
             r'\pagestyle{empty}'
         ])
     else:
         preamble.extend([''
-           ,r'\usepackage{fancyhdr}'
            ,r'\pagestyle{fancy}'
            ,r'\renewcommand{\headrulewidth}{0pt}'
            ,r'\renewcommand{\footrulewidth}{0pt}'
@@ -385,11 +1055,13 @@ def buildlatex(opt, filenames):
                 headfoot[i:i+3] = opt[hf] # assumed len=3
             elif opt[hf]: # string type = header/footer at center
                 headfoot[i+1] = opt[hf].replace('\t',r'\hfill{}')
+        if opt.get('lastpage') is not None: # total pages known ahead, see shardjob()
+            headfoot = [v.replace(r'\pageref{LastPage}', str(opt['lastpage'])) for v in headfoot]
         font,size = opt.get('header_font',[None,None])
         fontprepend = ''
         if font: # header font provided
             preamble.extend([''
-               ,r'\newfontfamily\Headerfont{%s}' % font
+               ,r'\newfontfamily\Headerfont' + fontspecfont(opt, font)
             ])
             fontprepend = r'\Headerfont'
         if size: # header font size provided
@@ -403,7 +1075,7 @@ def buildlatex(opt, filenames):
         if 'underlay' in opt:
             if opt['underlay']['font'][0]:
                 preamble.extend([''
-                    ,r'\newfontfamily\Overlayfont{%s}' % opt['underlay']['font'][0]
+                    ,r'\newfontfamily\Overlayfont' + fontspecfont(opt, opt['underlay']['font'][0])
                 ])
             headfoot[rh] += '\n'.join(filter(None,[''
                 ,r'\begin{tikzpicture}[remember picture,overlay]'
@@ -425,14 +1097,22 @@ def buildlatex(opt, filenames):
            ,r'\fancyfoot[%s]{%s}' % (right,headfoot[rf]) if headfoot[rf] else None
         ])
 
+    # file-dependent header fields, see headeroptions()
+    fielddefs = [''.join(r'\gdef%s{%s}' % field + '\n' for field in fields)
+                 for fields in opt.get('filefields') or [[]]*len(filenames)]
     body = [''
        ,r'\begin{document}'
        ,r'\fontsize{%(s)s}{%(s)s}\selectfont' % {'s':opt['font'][1]} if opt['font'][1] else None
+       ,r'\setcounter{page}{%d}' % opt['firstpage'] if opt.get('firstpage') else None
     ]+([r'\begin{multicols*}{%d}' % opt['multicols']
     ] if opt['multicols'] else [])+[
-       (r'\inputminted[%(a)s]{%(l)s}{%(f)s}' + '\n')
-            % {'a':','.join(opt['minted']), 'l':opt['mintedlang'], 'f':f}
-        for f in filenames
+       fielddefs[i]
+       +((r'\VerbatimInput[%(a)s]{%(f)s.pyg}' + '\n')
+            % {'a':','.join([r'commandchars=\\\{\}']+fvextraoptions(partminted(opt, i))), 'f':f}
+        if pygmentize else
+        (r'\inputminted[%(a)s]{%(l)s}{%(f)s}' + '\n')
+            % {'a':','.join(partminted(opt, i)), 'l':mintedlang(opt, f), 'f':f})
+        for i,f in enumerate(filenames)
     ]+([r'\end{multicols*}'
     ] if opt['multicols'] else [])+[''
        ,r'\label{LastPage}'
@@ -458,62 +1138,2044 @@ def cd(newdir, cleanup=lambda: True):
         cleanup()
 
 @contextlib.contextmanager
-def tempdir():
+def tempdir(chdir=True, root=None):
     '''a context manager to create a temp dir and change the working directory
     to it. Useful for learning up after running code that generate files in the
-    local dir.
+    local dir. Set `chdir` to False to keep the working directory, which is
+    necessary if multiple jobs run in threads. The temp dir is created in
+    `root` if provided, e.g. /dev/shm, otherwise in the system temp dir.
     '''
-    dirpath = tempfile.mkdtemp()
+    dirpath = tempfile.mkdtemp(dir=root)
     def cleanup():
         shutil.rmtree(dirpath)
+    if not chdir:
+        try:
+            yield dirpath
+        finally:
+            cleanup()
+        return
     with cd(dirpath, cleanup):
         yield dirpath
 
-def main():
-    args = parseargs()
-    if len(args.file) < 1:
-        logging.error('stdin entry is not yet supported')
-        sys.exit(1)
-    logging.getLogger('').setLevel(logging.ERROR if args.quiet else logging.DEBUG)
-    logging.debug(args)
-    options = latexoptions(args)
-    logging.debug(options)
-    files = ["source%d%s"%(i, os.path.splitext(f)[-1]) for i,f in enumerate(args.file)]
-    latexcode = buildlatex(options, files)
-    texfile = 'mintscript_temp.tex'
-    pdffile = texfile[:-3] + 'pdf'
-    cwd = os.getcwd()
-    with tempdir() as _:
-        for oldpath,newpath in zip(args.file, files):
-            oldpath = os.path.join(cwd, oldpath)
-            if not os.path.isfile(oldpath):
-                logging.error('Cannot read file %s' % oldpath)
-                sys.exit(1)
-            shutil.copyfile(oldpath, newpath)
-            logging.debug('Copied %s to %s' % (oldpath, newpath))
-        assert(texfile not in files)
-        with open(texfile,'w') as fp:
-            fp.write(latexcode)
-        logging.debug('LaTeX code:\n%s' % latexcode)
-        if args.quiet:
-            commandline = ['xelatex','-shell-escape','-interaction=batchmode','-8bit',texfile]
+def emptydir(dirpath, keep=lambda name: False):
+    '''Remove the content of a directory except the entries that `keep`
+    returns True for their names
+    '''
+    for name in os.listdir(dirpath):
+        if keep(name):
+            continue
+        path = os.path.join(dirpath, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
         else:
-            commandline = ['xelatex','-8bit','-shell-escape','-interaction=nonstopmode','-halt-on-error',texfile]
-        for i in range(2): # run latex twice due to labels
-            status = subprocess.call(commandline)
+            os.unlink(path)
+
+def docshape(options):
+    '''Digest of the layout options of a document, i.e., all but the input
+    files and the header and footer text, which may show file name and time.
+    Documents of the same shape share the pooled work directories
+    '''
+    shape = {k:v for k,v in options.items()
+             if k not in ['input', 'ranges', 'header', 'footer', 'filefields', 'firstpage', 'lastpage']}
+    return hashlib.sha1(json.dumps(shape, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def keepworkfile(name):
+    '''Files kept in a pooled work directory between jobs with the `inputs`
+    cleanup policy: the aux file for xelatex to start from the last labels, and
+    the minted cache of highlighted code
+    '''
+    return name.endswith('.aux') or name.startswith('_minted')
+
+def privatedir(path):
+    '''Create directory `path` accessible only by the current user, or check
+    that the existing one is, such that other users cannot plant files or
+    links in it
+
+    Raises:
+        RuntimeError: if `path` is not a directory of the user with mode 0700
+    '''
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != 0o700:
+        raise RuntimeError('%s is not a private directory of the user, refuse to use it' % path)
+    return path
+
+@contextlib.contextmanager
+def pooledworkdir(root, size, shape, cleanup='inputs', cachebase=None):
+    '''a context manager to check out a work directory from a pool of `size`
+    directories in `root`, shared by processes of the same user. Slots are
+    locked by flock. A free slot that last ran a document of the same `shape`
+    is preferred, otherwise the least recently used free slot is emptied and
+    taken. If all slots are busy, a temp dir is used instead
+
+    Args:
+        root (str): parent directory of the pool, default is $XDG_RUNTIME_DIR,
+                    or the cache directory without it
+        size (int): number of slots in the pool
+        shape (str): output of docshape()
+        cleanup (str): `inputs` to keep aux files and minted cache after the
+                       job, or `all` to empty the directory
+        cachebase (str): cache root directory, see cachedir()
+
+    Raises:
+        RuntimeError: if the pool directory is not private to the user
+    '''
+    root = root or os.environ.get('XDG_RUNTIME_DIR') or cachedir('workdirs', cachebase)
+    pooldir = privatedir(os.path.join(root, 'mintscript-pool-%d' % os.getuid()))
+    free = [] # (mtime of shape file, slot number, lock file, slot shape)
+    for i in range(size):
+        lockfp = open(os.path.join(pooldir, 'slot%d.lock' % i), 'a+')
+        try:
+            fcntl.flock(lockfp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lockfp.close() # busy
+            continue
+        lockfp.seek(0)
+        slotshape = lockfp.read().strip()
+        free.append((os.fstat(lockfp.fileno()).st_mtime, i, lockfp, slotshape))
+        if slotshape == shape:
+            break
+    if not free:
+        logging.debug('All %d pooled work directories busy, use a temp dir' % size)
+        with tempdir(chdir=False, root=root) as dirpath:
+            yield dirpath
+        return
+    chosen = free[-1] if free[-1][3] == shape else min(free)
+    for slot in free:
+        if slot is not chosen:
+            slot[2].close()
+    _, i, lockfp, slotshape = chosen
+    dirpath = os.path.join(pooldir, 'slot%d' % i)
+    try:
+        if not os.path.isdir(dirpath):
+            os.mkdir(dirpath)
+        else:
+            # a crashed job skips the cleanup below, leaving links to its inputs
+            emptydir(dirpath, keepworkfile if slotshape == shape else lambda name: False)
+        logging.debug('Pooled work directory %s (%s)'
+                      % (dirpath, 'reused' if slotshape == shape else 'new shape'))
+        lockfp.seek(0)
+        lockfp.truncate()
+        lockfp.write(shape)
+        lockfp.flush()
+        failed = True
+        try:
+            yield dirpath
+            failed = False
+        finally:
+            # a failed job may leave broken aux files behind
+            emptydir(dirpath, keepworkfile if cleanup == 'inputs' and not failed else
+                              lambda name: False)
+            if failed:
+                lockfp.truncate(0)
+    finally:
+        lockfp.close()
+
+@contextlib.contextmanager
+def jobworkdir(args, options=None):
+    '''Working directory of a job: a pooled work directory if `--workdir-pool`
+    is set and the job `options` are given, otherwise a temp dir in
+    `--workdir-root`
+    '''
+    if options is not None and args.workdir_pool:
+        with pooledworkdir(args.workdir_root, args.workdir_pool, docshape(options),
+                           args.workdir_cleanup, args.cache_dir) as dirpath:
+            yield dirpath
+    else:
+        with tempdir(chdir=False, root=args.workdir_root) as dirpath:
+            yield dirpath
+
+def cachedir(kind, basedir=None):
+    '''Locate a persistent cache directory, create it if not exists. The cache
+    root is `basedir` if provided, otherwise $MINTSCRIPT_CACHE or
+    $XDG_CACHE_HOME/mintscript, defaults to ~/.cache/mintscript
+
+    Args:
+        kind (str): name of the sub-directory for a particular type of cache
+        basedir (str): cache root directory, overrides the default
+
+    Returns:
+        str: path to the cache directory
+    '''
+    if not basedir:
+        basedir = os.environ.get('MINTSCRIPT_CACHE') or os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+            'mintscript')
+    dirpath = os.path.join(os.path.expanduser(basedir), kind)
+    if not os.path.isdir(dirpath):
+        os.makedirs(dirpath)
+    return dirpath
+
+def hashupdate(digest, path, blocksize=1<<20):
+    '''Feed the content of a file into a hashlib object in blocks such that
+    memory use does not depend on the file size
+    '''
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(blocksize), b''):
+            digest.update(block)
+    return digest
+
+@functools.lru_cache(maxsize=None)
+def toolversions():
+    '''Versions of the external tools that affect the generated PDF. Result is
+    memoized as they do not change during the lifetime of the process
+
+    Returns:
+        dict: program name to version string, or None if not found
+    '''
+    versions = {'xelatex':None, 'minted':None, 'pygments':None}
+    try:
+        output = subprocess.check_output(['xelatex','--version'], stderr=subprocess.DEVNULL)
+        versions['xelatex'] = output.decode('utf-8','replace').split('\n')[0].strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    try:
+        stypath = subprocess.check_output(['kpsewhich','minted.sty'], stderr=subprocess.DEVNULL)
+        with open(stypath.decode().strip(), 'rb') as fp:
+            m = re.search(rb'\\ProvidesPackage\{minted\}\s*\[([^\]]*)\]', fp.read())
+        versions['minted'] = m.group(1).decode('utf-8','replace') if m else 'unknown'
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    try:
+        import pygments
+        versions['pygments'] = pygments.__version__
+    except ImportError:
+        pass
+    return versions
+
+def cachekey(inputfiles, options, latexcode):
+    '''Content-addressed key for a PDF job. Time-dependent header and footer
+    fields are already expanded in `options` and `latexcode`, hence they are
+    part of the key
+
+    Args:
+        inputfiles (list of str): path to input files
+        options (dict): output of latexoptions()
+        latexcode (str): output of buildlatex()
+
+    Returns:
+        str: hex digest
+    '''
+    digest = hashlib.sha256()
+    digest.update(json.dumps(toolversions(), sort_keys=True).encode('utf-8'))
+    digest.update(json.dumps(options, sort_keys=True, default=repr).encode('utf-8'))
+    digest.update(latexcode.encode('utf-8'))
+    for path in inputfiles:
+        digest.update(b'\0')
+        hashupdate(digest, path)
+    return digest.hexdigest()
+
+def cachelookup(dirpath, key, suffix):
+    '''Find an entry in a cache directory and mark it as recently used
+
+    Returns:
+        str: path to the cache entry, or None if not found
+    '''
+    entry = os.path.join(dirpath, key + suffix)
+    try:
+        os.utime(entry) # mtime as last access time for LRU eviction
+    except OSError:
+        return None
+    return entry
+
+def cachestore(dirpath, key, suffix, srcpath, maxbytes):
+    '''Save a file into cache atomically and evict least recently used entries
+    if the cache grown beyond `maxbytes`. Eviction is skipped if `maxbytes` is
+    None, for the caller to prune once after a number of stores
+    '''
+    fd, tmppath = tempfile.mkstemp(dir=dirpath, prefix='.tmp-')
+    os.close(fd)
+    try:
+        shutil.copyfile(srcpath, tmppath)
+        os.replace(tmppath, os.path.join(dirpath, key + suffix))
+    except (IOError, OSError):
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+        raise
+    if maxbytes is not None:
+        cacheprune(dirpath, maxbytes)
+
+def cacheprune(dirpath, maxbytes):
+    '''Remove least recently used entries from a cache directory until its size
+    is within `maxbytes`. A lock file serializes concurrent evictions
+    '''
+    with open(os.path.join(dirpath, '.lock'), 'w') as lockfp:
+        fcntl.flock(lockfp, fcntl.LOCK_EX)
+        entries = []
+        for name in os.listdir(dirpath):
+            if name.startswith('.'):
+                continue # lock file and incomplete writes
+            try:
+                st = os.stat(os.path.join(dirpath, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _,size,_ in entries)
+        for _, size, name in sorted(entries):
+            if total <= maxbytes:
+                break
+            try:
+                os.unlink(os.path.join(dirpath, name))
+                logging.debug('Evicted %s from cache' % name)
+            except OSError:
+                pass
+            total -= size
+
+STATSLOCK = threading.Lock()
+
+@contextlib.contextmanager
+def timed(stats, phase):
+    '''Accumulate the wall time of a block into `stats['phases'][phase]`. No-op
+    if stats is None. Blocks running in parallel threads, e.g. the chunks of
+    shardjob(), add up, so a phase can exceed the wall time of the run
+    '''
+    start = time.time()
+    try:
+        yield
+    finally:
+        if stats is not None:
+            with STATSLOCK:
+                phases = stats.setdefault('phases', {})
+                phases[phase] = phases.get(phase, 0) + time.time() - start
+
+def runcommand(commandline, stats=None, **kwargs):
+    '''subprocess.call() that records the command, its wall time and return
+    code into `stats['subprocesses']` if stats is not None
+    '''
+    start = time.time()
+    status = subprocess.call(commandline, **kwargs)
+    recordcommand(stats, commandline, start, status)
+    return status
+
+def recordcommand(stats, commandline, start, status):
+    '''Record a finished subprocess started at time `start`, see runcommand()
+    '''
+    if stats is not None:
+        with STATSLOCK:
+            stats.setdefault('subprocesses', []).append({'command':commandline
+                ,'seconds':time.time()-start, 'returncode':status})
+
+def parselatexlog(logfile):
+    '''Extract statistics from a xelatex log: number of pages, overfull and
+    underfull boxes, and TeX memory usage
+
+    Returns:
+        dict: statistics found in the log
+    '''
+    with open(logfile, 'rb') as fp:
+        log = fp.read().decode('utf-8', 'replace')
+    stats = {'pages':None, 'overfull':len(re.findall(r'^Overfull \\[hv]box', log, re.M))
+            ,'underfull':len(re.findall(r'^Underfull \\[hv]box', log, re.M)), 'memory':{}}
+    m = re.search(r'Output written on .*?\((\d+) pages?', log, re.S)
+    if m:
+        stats['pages'] = int(m.group(1))
+    m = re.search(r"Here is how much of TeX's memory you used:\n((?: .*\n)+)", log)
+    if m:
+        for line in m.group(1).splitlines():
+            used = re.match(r'\s*(\S+) (.*?) out of (\S+)', line)
+            if used: # e.g. "12345 strings out of 478287"
+                stats['memory'][used.group(2)] = [used.group(1), used.group(3)]
+    return stats
+
+def filedigest(path):
+    '''Digest of a file content, or None if the file does not exist
+    '''
+    try:
+        return hashupdate(hashlib.sha1(), path).hexdigest()
+    except (IOError, OSError):
+        return None
+
+def needsaux(latexcode):
+    '''Whether a document reads anything back from its aux file: the labels of
+    page references (`$=` in header or footer), or the positions of `remember
+    picture` nodes such as the underlay
+    '''
+    return re.search(r'\\(page)?ref\{|remember picture', latexcode) is not None
+
+def runlatex(commandline, latexcode, auxfile, maxpasses=3, cwd=None, stats=None, driver=None):
+    '''Run xelatex as many times as needed for cross references. The first
+    pass is sufficient if the document needs nothing from the aux file, see
+    needsaux(), otherwise rerun until the aux file settled. With `-no-pdf`,
+    the passes write XDV only and the PDF driver runs once after the last pass
+
+    Args:
+        commandline (list): xelatex command to run
+        latexcode (str): the LaTeX document being compiled
+        auxfile (str): path to the aux file written by xelatex
+        maxpasses (int): upper bound of the number of passes
+        cwd (str): directory to run xelatex, default is the current directory
+        stats (dict): to collect run statistics, see runcommand()
+        driver (list): output of pdfcommand(), to run after the last pass
+
+    Returns:
+        int: number of passes run
+    '''
+    rerun = needsaux(latexcode)
+    for passes in range(1, maxpasses+1):
+        before = filedigest(auxfile)
+        status = runcommand(commandline, stats, cwd=cwd)
+        if status != 0:
+            raise subprocess.CalledProcessError(status, commandline)
+        if not rerun or filedigest(auxfile) == before:
+            break # labels and positions unchanged since last pass
+    logging.debug('xelatex completed in %d pass(es)' % passes)
+    if driver:
+        status = runcommand(driver, stats, cwd=cwd)
+        if status != 0:
+            raise subprocess.CalledProcessError(status, driver)
+    return passes
+
+async def waitprocess(proc):
+    '''Wait for a subprocess started by asyncio. If the waiting task is
+    cancelled, e.g. by a timeout, the process is killed and reaped before the
+    cancellation goes on, so that it does not outlive its work directory
+
+    Returns:
+        int: return code of the process
+    '''
+    try:
+        return await proc.wait()
+    except asyncio.CancelledError:
+        try:
+            proc.kill()
+        except ProcessLookupError:
+            pass # exited meanwhile
+        await proc.wait()
+        raise
+
+async def runlatexasync(commandline, latexcode, auxfile, maxpasses=3, cwd=None, stats=None,
+                        driver=None):
+    '''runlatex() with xelatex run by asyncio, not to block the event loop
+    '''
+    rerun = needsaux(latexcode)
+    for passes in range(1, maxpasses+1):
+        before = filedigest(auxfile)
+        start = time.time()
+        proc = await asyncio.create_subprocess_exec(*commandline, cwd=cwd)
+        status = await waitprocess(proc)
+        recordcommand(stats, commandline, start, status)
+        if status != 0:
+            raise subprocess.CalledProcessError(status, commandline)
+        if not rerun or filedigest(auxfile) == before:
+            break # labels and positions unchanged since last pass
+    logging.debug('xelatex completed in %d pass(es)' % passes)
+    if driver:
+        start = time.time()
+        proc = await asyncio.create_subprocess_exec(*driver, cwd=cwd)
+        status = await waitprocess(proc)
+        recordcommand(stats, driver, start, status)
+        if status != 0:
+            raise subprocess.CalledProcessError(status, driver)
+    return passes
+
+def latexformat(latexcode, texfile, fmtcache, maxbytes, shellescape=True, cwd='', stats=None):
+    '''Prepare a precompiled format of the preamble in the working directory
+    using mylatexformat. The format is dumped from the part of `latexcode` up to
+    ENDOFDUMP and cached by the digest of that text together with the TeX
+    distribution version
+
+    Args:
+        latexcode (str): the LaTeX document, already written to `texfile`
+        texfile (str): file name of the LaTeX document in the working directory
+        fmtcache (str): cache directory for format files
+        maxbytes (int): size limit of the format cache
+        shellescape (bool): whether the document needs -shell-escape
+        cwd (str): the working directory, default is the current directory
+        stats (dict): to collect run statistics, see runcommand()
+
+    Returns:
+        str: format name to use with `xelatex -fmt`, or None if a format cannot
+        be made
+    '''
+    if ENDOFDUMP not in latexcode:
+        return None
+    fmtname = 'mintscript_fmt'
+    digest = hashlib.sha256()
+    digest.update(json.dumps(toolversions()['xelatex']).encode('utf-8'))
+    try:
+        basefmt = subprocess.check_output(['kpsewhich','-engine=xetex','xelatex.fmt'],
+                                          stderr=subprocess.DEVNULL).decode().strip()
+        digest.update(('%s:%s' % (basefmt, os.stat(basefmt).st_mtime)).encode('utf-8'))
+    except (OSError, subprocess.CalledProcessError):
+        pass # cannot locate base format, rely on the version string only
+    digest.update(str(shellescape).encode('utf-8'))
+    digest.update(latexcode.split(ENDOFDUMP)[0].encode('utf-8'))
+    key = digest.hexdigest()
+    cached = cachelookup(fmtcache, key, '.fmt')
+    if cached:
+        try:
+            shutil.copyfile(cached, os.path.join(cwd, fmtname + '.fmt'))
+            logging.info('Format cache hit: %s' % key)
+            return fmtname
+        except (IOError, OSError):
+            pass # evicted by a concurrent process, dump again
+    logging.info('Format cache miss: %s' % key)
+    jobname = os.path.splitext(texfile)[0] # same \jobname as the real runs
+    commandline = ['xelatex','-ini','-interaction=batchmode','-jobname=%s' % jobname
+                  ,'&xelatex','mylatexformat.ltx',texfile]
+    if shellescape:
+        commandline.insert(1, '-shell-escape')
+    status = runcommand(commandline, stats, cwd=cwd or None)
+    if status != 0 or not os.path.isfile(os.path.join(cwd, jobname + '.fmt')):
+        logging.warning('Cannot dump format (return code %s), compile without it' % status)
+        return None
+    fmtpath = os.path.join(cwd, fmtname + '.fmt')
+    os.rename(os.path.join(cwd, jobname + '.fmt'), fmtpath)
+    cachestore(fmtcache, key, '.fmt', fmtpath, maxbytes)
+    return fmtname
+
+@contextlib.contextmanager
+def openoutput(output):
+    '''a context manager to write the output PDF: yields a binary file object
+    of stdout if output is `-`, otherwise of a temp file next to the output
+    file, which replaces the output file atomically upon success. Hence a
+    reader never sees a partially written PDF. An existing output file keeps
+    its permissions
+    '''
+    if output == '-':
+        yield sys.stdout.buffer
+        sys.stdout.buffer.flush()
+        return
+    dirpath, name = os.path.split(output)
+    tmppath = os.path.join(dirpath, '.%s.%d.%d.tmp' % (name, os.getpid(), threading.get_ident()))
+    try:
+        with open(tmppath, 'wb') as fp:
+            yield fp
+        if os.path.exists(output):
+            shutil.copymode(output, tmppath)
+        os.replace(tmppath, output)
+    except BaseException:
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+        raise
+
+def writeoutput(pdffile, output):
+    '''Deliver the generated PDF to output file, or stdout if output is `-`
+    '''
+    if output:
+        with openoutput(output) as dst, open(pdffile, 'rb') as fp:
+            shutil.copyfileobj(fp, dst, CHUNKSIZE)
+
+CHUNKSIZE = 1<<16 # block size for streaming data in bounded memory
+
+FICLONE = 0x40049409 # ioctl to share extents between files, from linux/fs.h
+
+def linkfile(srcpath, dstpath):
+    '''Make `dstpath` refer to the content of `srcpath` without copying data
+    if possible: by hardlink, reflink (copy-on-write clone, on filesystems such
+    as btrfs and xfs), or symlink, and copy only if all of them failed. The
+    `dstpath` must not exist, an existing entry is never written through
+
+    Returns:
+        str: the method used, one of hardlink, reflink, symlink, or copy
+    '''
+    try:
+        os.link(srcpath, dstpath)
+        return 'hardlink'
+    except OSError:
+        pass # cross-device, or not permitted
+    created = False
+    try:
+        with open(srcpath, 'rb') as src, open(dstpath, 'xb') as dst:
+            created = True
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return 'reflink'
+    except (IOError, OSError):
+        if created:
+            os.unlink(dstpath)
+    try:
+        os.symlink(os.path.abspath(srcpath), dstpath)
+        return 'symlink'
+    except OSError:
+        pass
+    with open(srcpath, 'rb') as src, open(dstpath, 'xb') as dst:
+        shutil.copyfileobj(src, dst, CHUNKSIZE)
+    return 'copy'
+
+def copyrange(srcpath, dstpath, start, end):
+    '''Copy bytes `start` to `end` of `srcpath` into a new file `dstpath`,
+    inside the kernel by copy_file_range() where available, otherwise in chunks
+    '''
+    with open(srcpath, 'rb') as src, open(dstpath, 'xb') as dst:
+        offset = start
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while offset < end:
+                    n = os.copy_file_range(src.fileno(), dst.fileno(), end-offset, offset)
+                    if n == 0:
+                        break
+                    offset += n
+            except OSError:
+                pass # not supported by the filesystem, copy the rest in chunks
+        src.seek(offset)
+        copystream(src, dst, end-offset)
+
+LINEINDEXSTRIDE = 1024 # lines between two entries of the sparse line index
+
+def parseranges(spec, first=0):
+    '''Parse ranges of --lines or --bytes, e.g. `100:200,5000:`. Either end
+    may be omitted for the start or the end of the file
+
+    Args:
+        spec (str): comma separated ranges `START:END`
+        first (int): smallest valid value
+
+    Returns:
+        list of tuple: start and end of each range, None if omitted
+
+    Raises:
+        RuntimeError: if a range is malformed
+    '''
+    ranges = []
+    for item in spec.split(','):
+        match = re.match(r'^\s*(\d*):(\d*)\s*$', item)
+        if not match:
+            raise RuntimeError('Invalid range %s' % item)
+        start, end = [int(n) if n else None for n in match.groups()]
+        if any(n is not None and n < first for n in (start, end)) \
+                or (start is not None and end is not None and start > end):
+            raise RuntimeError('Invalid range %s' % item)
+        ranges.append((start, end))
+    return ranges
+
+def lineindexfile(args, path):
+    '''Path to the persistent line index of file `path`: next to the file
+    with `--line-index beside`, in the cache directory by default
+
+    Returns:
+        str: path to the index file, or None if the index is not kept
+    '''
+    if args.line_index == 'beside':
+        return path + '.lineidx'
+    if args.line_index == 'cache' and not args.no_cache:
+        name = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest() + '.idx'
+        return os.path.join(cachedir('lineindex', args.cache_dir), name)
+    return None
+
+def lineindex(path, mm, indexfile=None, stride=LINEINDEXSTRIDE):
+    '''Sparse line index of a file: the byte offset of every `stride`-th
+    line, found by a regular expression running over the memory-mapped file.
+    The index is kept in `indexfile` across runs. If the file only grew since,
+    as logs do, the index is extended from its last entry
+
+    Args:
+        path (str): the indexed file
+        mm (mmap.mmap): the file mapped into memory
+        indexfile (str): path to the persistent index, or None
+        stride (int): number of lines between two entries
+
+    Returns:
+        array.array: offsets of line 1, stride+1, 2*stride+1, and so on
+    '''
+    st = os.stat(path)
+    meta = {'size':st.st_size, 'mtime':st.st_mtime, 'ino':st.st_ino, 'stride':stride}
+    tail = lambda offsets, size: hashlib.sha1(mm[max(0, offsets[-1]-4096):size]).hexdigest()
+    offsets = array.array('Q', [0])
+    if indexfile:
+        try:
+            with open(indexfile, 'rb') as fp:
+                old = json.loads(fp.readline().decode('utf-8'))
+                cached = array.array('Q', fp.read())
+        except (IOError, OSError, ValueError):
+            old = None # no index yet or corrupted, start over
+        if old and cached and old['ino'] == st.st_ino and old['stride'] == stride:
+            if old['size'] == st.st_size and old['mtime'] == st.st_mtime:
+                logging.debug('Line index of %s from %s' % (path, indexfile))
+                return cached
+            if old['size'] < st.st_size and old['tail'] == tail(cached, old['size']):
+                logging.debug('Extend line index of %s from %d bytes' % (path, old['size']))
+                offsets = cached # appended to
+    pattern = re.compile(br'(?:[^\n]*\n){%d}' % stride)
+    match = pattern.match(mm, offsets[-1])
+    while match:
+        offsets.append(match.end())
+        match = pattern.match(mm, match.end())
+    if indexfile:
+        meta['tail'] = tail(offsets, st.st_size)
+        try:
+            fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(indexfile)),
+                                           prefix='.tmp-')
+            with os.fdopen(fd, 'wb') as fp:
+                fp.write(json.dumps(meta, sort_keys=True).encode('utf-8') + b'\n')
+                offsets.tofile(fp)
+            os.replace(tmppath, indexfile)
+        except (IOError, OSError) as e:
+            logging.warning('Cannot write line index %s: %s' % (indexfile, e))
+    return offsets
+
+def lineoffset(mm, offsets, line, stride=LINEINDEXSTRIDE):
+    '''Byte offset of the start of line number `line` by the line index, or
+    the size of the file if the file has fewer lines
+    '''
+    entry = min((line-1) // stride, len(offsets)-1)
+    pos = offsets[entry]
+    for _ in range(line-1 - entry*stride):
+        pos = mm.find(b'\n', pos) + 1
+        if pos == 0:
+            return len(mm)
+    return pos
+
+def linenumber(mm, offsets, pos, stride=LINEINDEXSTRIDE):
+    '''Number of the line at byte offset `pos` by the line index
+    '''
+    entry = bisect.bisect_right(offsets, pos) - 1
+    return entry*stride + mm[offsets[entry]:pos].count(b'\n') + 1
+
+def selectranges(args):
+    '''Narrow the input files to the line ranges of --lines, or to the byte
+    ranges of --bytes widened to whole lines. Each range of each file becomes
+    a part of the document, located through the line index of the file, such
+    that stageinputs() copies only the bytes of the ranges
+
+    Args:
+        args: argparse namespace object
+
+    Returns:
+        tuple: list of input files, one per part, and list of tuples of the
+        number of the first line, start offset and end offset of each part
+
+    Raises:
+        RuntimeError: if input cannot be read or no line is selected
+    '''
+    if '-' in args.file or args.filter:
+        raise RuntimeError('Line and byte ranges need input files, not stdin or an input filter')
+    bylines = args.lines is not None
+    spec = parseranges(args.lines if bylines else args.bytes, 1 if bylines else 0)
+    inputfiles, ranges = [], []
+    for path in args.file:
+        if not os.path.isfile(path):
+            raise RuntimeError('Cannot read file %s' % os.path.abspath(path))
+        if os.path.getsize(path) == 0:
+            continue # cannot be mapped, and has no line anyway
+        with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offsets = lineindex(path, mm, lineindexfile(args, path))
+            for start, end in spec:
+                if bylines:
+                    first = start or 1
+                    begin = lineoffset(mm, offsets, first)
+                    stop = len(mm) if end is None else lineoffset(mm, offsets, end+1)
+                else:
+                    start, end = start or 0, len(mm) if end is None else min(end, len(mm))
+                    if start < end: # from the line of the first byte to that of the last
+                        begin = mm.rfind(b'\n', 0, start) + 1
+                        stop = mm.find(b'\n', end-1) + 1 or len(mm)
+                    else:
+                        begin = stop = end
+                    first = linenumber(mm, offsets, begin)
+                if begin >= stop:
+                    logging.warning('Range %s:%s of %s is empty'
+                                    % ('' if start is None else start, '' if end is None else end, path))
+                    continue
+                inputfiles.append(path)
+                ranges.append((first, begin, stop))
+    if not inputfiles:
+        raise RuntimeError('No line in the selected ranges')
+    logging.info('Selected %d range(s), %d bytes' % (len(ranges), sum(r[2]-r[1] for r in ranges)))
+    return inputfiles, ranges
+
+def stageinputs(inputfiles, filenames, workdir, filtercmd=None, filterstdin=None, stats=None,
+                ranges=None):
+    '''Place input files into the working directory under the names used in
+    the LaTeX document. Input file `-` is stdin. With an input filter, the
+    output of the filter is staged instead; with ranges, only the bytes of the
+    range. Data are streamed either by the OS or in chunks, hence memory use
+    does not depend on the input size
+
+    Args:
+        inputfiles (list of str): path to input files, or `-` for stdin
+        filenames (list of str): file names in the working directory
+        workdir (str): the working directory
+        filtercmd (str): shell command of input filter, `%s` in it is replaced
+            by the input file name, otherwise the input is fed to its stdin
+        filterstdin (str): how stdin is shown to the filter as `%s`
+        stats (dict): to collect run statistics, see runcommand()
+        ranges (list): for each input file, None or the range of it to stage,
+            as output by selectranges()
+
+    Returns:
+        dict: number of bytes staged by each method of linkfile()
+    '''
+    staged = dict.fromkeys(['hardlink','reflink','symlink','copy'], 0)
+    for i, (oldpath, newpath) in enumerate(zip(inputfiles, filenames)):
+        dstpath = os.path.join(workdir, newpath)
+        if os.path.lexists(dstpath):
+            # a leftover link to an earlier input, never write through it
+            os.unlink(dstpath)
+        if ranges and ranges[i]:
+            first, start, end = ranges[i]
+            copyrange(oldpath, dstpath, start, end)
+            logging.debug('Staged lines from %d of %s to %s' % (first, oldpath, newpath))
+        elif filtercmd:
+            if '%s' in filtercmd:
+                name = (filterstdin or '') if oldpath == '-' else shlex.quote(oldpath)
+                commandline, stdin = filtercmd.replace('%s', name), None
+            else:
+                commandline, stdin = filtercmd, None if oldpath == '-' else open(oldpath, 'rb')
+            if stdin is None and oldpath != '-':
+                stdin = subprocess.DEVNULL # filter reads the file by name
+            try:
+                with open(dstpath, 'xb') as fp:
+                    status = runcommand(commandline, stats, shell=True, stdin=stdin, stdout=fp)
+            finally:
+                if hasattr(stdin, 'close'):
+                    stdin.close()
             if status != 0:
-                logging.error('xelatex failed with return code %s' % status)
-                sys.exit(status)
-        if not os.path.isfile(pdffile):
-            logging.error('xelatex completed but %s not found in output' % pdffile)
-            sys.exit(1)
-        if not args.output:
-            args.output = os.path.splitext(args.file[0])[0] + '.pdf'
+                raise RuntimeError('Input filter failed with return code %s' % status)
+            logging.debug('Filtered %s to %s' % (oldpath, newpath))
+        elif oldpath == '-':
+            with open(dstpath, 'xb') as fp:
+                shutil.copyfileobj(sys.stdin.buffer, fp, CHUNKSIZE)
+            logging.debug('Copied stdin to %s' % newpath)
+        else:
+            method = linkfile(oldpath, dstpath)
+            staged[method] += os.path.getsize(dstpath)
+            logging.debug('Staged %s to %s by %s' % (oldpath, newpath, method))
+            continue
+        staged['copy'] += os.path.getsize(dstpath)
+    logging.info('Staged inputs: %d bytes linked, %d bytes copied'
+                 % (staged['hardlink']+staged['reflink']+staged['symlink'], staged['copy']))
+    return staged
+
+# paper sizes of the geometry package in PostScript points, for the native backend
+PAPERSIZES = {'letterpaper':(612, 792), 'legalpaper':(612, 1008), 'executivepaper':(522, 756)
+             ,'a3paper':(841.89, 1190.55), 'a4paper':(595.28, 841.89), 'a5paper':(419.53, 595.28)
+             ,'b5paper':(498.90, 708.66)}
+
+# TeX length units in PostScript points
+LENGTHUNITS = {'pt':72/72.27, 'bp':1.0, 'mm':72/25.4, 'cm':72/2.54, 'in':72.0, 'pc':12*72/72.27}
+
+# wrap markers of --mark-wrapped-lines in the native backend, Courier has no box
+# or carriage return glyph in WinAnsiEncoding
+NATIVEMARKERS = {'+':'+', r'$\Box$':'#', r'\carriagereturn':'\u00ac'}
+
+def parselength(value):
+    '''Convert a TeX length, e.g. `15mm`, into PostScript points. A number
+    without unit is in TeX points
+    '''
+    m = re.match(r'\s*([-+]?(?:\d+\.?\d*|\.\d+))\s*([a-z]*)\s*$', str(value))
+    if not m or (m.group(2) and m.group(2) not in LENGTHUNITS):
+        raise RuntimeError('Cannot parse length %s' % value)
+    return float(m.group(1)) * LENGTHUNITS[m.group(2) or 'pt']
+
+def nativelayout(opt):
+    '''Page layout of the native backend from the output of latexoptions()
+
+    Returns:
+        dict: page size, margins, columns, font size and line layout in points
+
+    Raises:
+        RuntimeError: if an option is not supported by the native backend
+    '''
+    layout = {'paper':PAPERSIZES['letterpaper'], 'landscape':False, 'twoside':False
+             ,'margins':[parselength('15mm')]*4, 'columns':1, 'colsep':10.0
+             ,'fontsize':parselength(opt['font'][1] or '10pt'), 'stretch':1.0, 'linenos':None
+             ,'wrap':'word', 'marker':None, 'tabsize':8, 'encoding':'utf-8', 'frame':False
+             ,'headersize':parselength(opt['header_font'][1] or '10pt')
+             ,'firstlines':[r[0] if r else 1 for r in opt.get('ranges') or []]}
+    for item in opt['geometry']:
+        key, _, value = item.partition('=')
+        if key.lower() in PAPERSIZES or key.lower() + 'paper' in PAPERSIZES:
+            layout['paper'] = PAPERSIZES[key.lower() if key.lower() in PAPERSIZES else key.lower()+'paper']
+        elif key == 'landscape':
+            layout['landscape'] = True
+        elif key == 'twoside':
+            layout['twoside'] = True
+        elif key == 'twocolumn':
+            layout['columns'] = 2
+        elif key == 'margin':
+            layout['margins'] = [parselength(value)]*4
+        elif key in ['left', 'right', 'top', 'bottom']:
+            layout['margins'][['left', 'right', 'top', 'bottom'].index(key)] = parselength(value)
+        elif key not in ['xetex', 'onecolumn', 'portrait']:
+            raise RuntimeError('Geometry option %s not supported by the native backend' % item)
+    if opt['multicols']:
+        layout['columns'], layout['colsep'] = opt['multicols'], parselength('5mm')
+    for item in opt['minted']:
+        key, _, value = item.partition('=')
+        if key == 'linenos':
+            layout['linenos'] = layout['linenos'] or 1
+        elif key == 'firstnumber':
+            layout['linenos'] = int(value)
+        elif key == 'breaklines':
+            layout['wrap'] = 'truncate' if value == 'false' else layout['wrap']
+        elif key == 'breakanywhere':
+            layout['wrap'] = 'anywhere' if layout['wrap'] != 'truncate' else 'truncate'
+        elif key == 'breaksymbolright':
+            symbol = value.replace(r'\small', '', 1)
+            layout['marker'] = NATIVEMARKERS.get(symbol, symbol)
+        elif key == 'tabsize':
+            layout['tabsize'] = int(value)
+        elif key == 'encoding':
+            layout['encoding'] = value
+        elif key == 'baselinestretch':
+            layout['stretch'] = float(value)
+        elif key == 'frame':
+            layout['frame'] = True
+        elif key != 'python3':
+            raise RuntimeError('Option %s not supported by the native backend' % item)
+    width, height = layout['paper'][::-1] if layout['landscape'] else layout['paper']
+    left, right, top, bottom = layout['margins']
+    layout['pagesize'] = (width, height)
+    layout['colwidth'] = (width - left - right - (layout['columns']-1)*layout['colsep']) / layout['columns']
+    layout['leading'] = layout['fontsize'] * layout['stretch']
+    layout['chars'] = max(1, int(layout['colwidth'] / (0.6*layout['fontsize']))) # Courier is 600 units wide
+    layout['rows'] = max(1, int((height - top - bottom) / layout['leading']))
+    return layout
+
+def nativerows(layout, inputfiles):
+    '''Lay out the lines of the input files into rows of a column. Files are
+    read line by line, hence memory use does not depend on the input size
+
+    Yields:
+        tuple: index of the file, line number or None for a continued row,
+        text of the row, and whether the line continues in the next row
+    '''
+    chars = layout['chars']
+    for i, path in enumerate(inputfiles):
+        first = layout['firstlines'][i] if layout['firstlines'] else 1 # of parts, see selectranges()
+        with open(path, encoding=layout['encoding'], errors='replace', newline='') as fp:
+            for n, line in enumerate(fp):
+                line = line.rstrip('\r\n').expandtabs(layout['tabsize'])
+                number = n + layout['linenos'] + first - 1 if layout['linenos'] else None
+                if layout['wrap'] == 'truncate' or len(line) <= chars:
+                    yield i, number, line[:chars], False
+                    continue
+                while len(line) > chars:
+                    cut = chars
+                    if layout['wrap'] == 'word':
+                        space = line.rfind(' ', 0, chars+1)
+                        cut = space+1 if space > 0 else chars # no space, break anywhere
+                    yield i, number, line[:cut], True
+                    line, number = line[cut:], None
+                yield i, number, line, False
+
+def pdfstring(text):
+    '''PDF literal string of text in WinAnsiEncoding, as in the core fonts'''
+    data = text.encode('cp1252', 'replace')
+    return b'(' + data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)') + b')'
+
+def nativeheadfoot(text, page, total, fields):
+    '''Plain text of a header or footer field rendered by renderformat()'''
+    text = re.sub(r'\\(mintscriptfield[a-j]+)\{\}', lambda m: fields.get('\\'+m.group(1), ''), text)
+    text = text.replace(r'\thepage{}', str(page)).replace(r'\pageref{LastPage}', str(total))
+    return text.replace('\\_', '_')
+
+def nativepage(opt, layout, columns, page, total, fields):
+    '''Content stream of a page of the native backend
+
+    Args:
+        opt (dict): output of latexoptions()
+        layout (dict): output of nativelayout()
+        columns (list): rows of each column on the page from nativerows()
+        page (int): page number to print
+        total (int): total number of pages to print, or None if not known
+        fields (dict): values of file-dependent header fields, see headeroptions()
+
+    Returns:
+        bytes: the content stream
+    '''
+    width, height = layout['pagesize']
+    left, right, top, bottom = layout['margins']
+    if layout['twoside'] and page % 2 == 0:
+        left, right = right, left
+    size, leading, charw = layout['fontsize'], layout['leading'], 0.6*layout['fontsize']
+    ops = []
+    if 'underlay' in opt:
+        ul = opt['underlay']
+        ulsize = parselength(ul['font'][1] or 64)
+        angle = math.radians(ul['angle'])
+        c, s = math.cos(angle), math.sin(angle)
+        dx, dy = -0.3*ulsize*len(ul['text']), -0.35*ulsize # center the text
+        x = width/2 + parselength('%scm' % ul['xpos']) + dx*c - dy*s
+        y = height/2 + parselength('%scm' % ul['ypos']) + dx*s + dy*c
+        gray = 1 - ul['gray']/100.0
+        ops.append(b'q %.3f g %.3f G BT %d Tr /F1 %.2f Tf %.4f %.4f %.4f %.4f %.2f %.2f Tm %s Tj ET Q'
+                   % (gray, gray, 1 if ul['style'] == 'outline' else 0, ulsize, c, s, -s, c, x, y,
+                      pdfstring(ul['text'])))
+    for col, rows in enumerate(columns):
+        x = left + col*(layout['colwidth'] + layout['colsep'])
+        y = height - top - size
+        if not rows:
+            continue
+        if layout['frame']:
+            ops.append(b'0.4 w %.2f %.2f %.2f %.2f re S'
+                       % (x-2, height-top-len(rows)*leading-2, layout['colwidth']+4, len(rows)*leading+4))
+        ops.append(b'BT /F1 %.2f Tf %.2f TL %.2f %.2f Td' % (size, leading, x, y))
+        ops.extend(pdfstring(text) + b" '" if r else pdfstring(text) + b' Tj'
+                   for r, (_, _, text, _) in enumerate(rows))
+        ops.append(b'ET')
+        marks = [(r, number, cont) for r, (_, number, _, cont) in enumerate(rows)
+                 if number is not None or (cont and layout['marker'])]
+        if marks:
+            ops.append(b'BT /F1 %.2f Tf' % size)
+            for r, number, cont in marks:
+                if number is not None: # right aligned at 12pt left of the text, as minted
+                    ops.append(b'1 0 0 1 %.2f %.2f Tm %s Tj'
+                               % (x - 12 - charw*len(str(number)), y - r*leading, pdfstring(str(number))))
+                if cont and layout['marker']:
+                    ops.append(b'1 0 0 1 %.2f %.2f Tm %s Tj'
+                               % (x + charw*layout['chars'] + 2, y - r*leading, pdfstring(layout['marker'])))
+            ops.append(b'ET')
+    for hf, ypos in [('header', height - top/2), ('footer', bottom/2)]:
+        parts = opt[hf]
+        if not parts:
+            continue
+        if isinstance(parts, str):
+            parts = parts.split('\t')
+            parts = {1:['', parts[0], ''], 2:[parts[0], '', parts[-1]]}.get(len(parts), parts[:3])
+        parts = [nativeheadfoot(p, page, total, fields) for p in parts]
+        if layout['twoside'] and page % 2 == 0:
+            parts = parts[::-1]
+        hsize = layout['headersize']
+        textwidth = width - left - right
+        ops.append(b'BT /F1 %.2f Tf' % hsize)
+        for part, xpos in zip(parts, [0, 0.5, 1]):
+            if part:
+                x = left + xpos*(textwidth - 0.6*hsize*len(part))
+                ops.append(b'1 0 0 1 %.2f %.2f Tm %s Tj' % (x, ypos, pdfstring(part)))
+        ops.append(b'ET')
+    return b'\n'.join(ops)
+
+def nativepdf(opt, inputfiles, fp, stats=None):
+    '''Native backend: write plain text input files as PDF with the core
+    Courier font, without LaTeX. Pages are written to `fp` as they are laid
+    out; only the object offsets are kept in memory. If the header or footer
+    shows the total number of pages, the input is laid out once before to
+    count the pages
+
+    Args:
+        opt (dict): output of latexoptions()
+        inputfiles (list of str): paths to the input files
+        fp: binary file object to write the PDF, need not be seekable
+
+    Returns:
+        int: number of pages
+    '''
+    layout = nativelayout(opt)
+    perpage = layout['rows'] * layout['columns']
+    total = opt.get('lastpage')
+    if total is None and r'\pageref{LastPage}' in json.dumps([opt['header'], opt['footer']]):
+        with timed(stats, 'layout'):
+            total = max(1, -(-sum(1 for _ in nativerows(layout, inputfiles)) // perpage))
+    offsets = [0, 0, 0, 0] # object number to offset, objects 1-3 are fixed
+    written = [0]
+    def write(data):
+        fp.write(data)
+        written[0] += len(data)
+    def writeobj(num, data):
+        while len(offsets) <= num:
+            offsets.append(0)
+        offsets[num] = written[0]
+        write(b'%d 0 obj\n' % num + data + b'\nendobj\n')
+    def writepage(rows, page, fileindex):
+        columns = [rows[i:i+layout['rows']] for i in range(0, perpage, layout['rows'])]
+        fields = dict(opt['filefields'][fileindex]) if opt.get('filefields') else {}
+        content = zlib.compress(nativepage(opt, layout, columns, page, total, fields))
+        num = len(offsets)
+        writeobj(num, b'<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(content)
+                      + content + b'\nendstream')
+        writeobj(num+1, b'<< /Type /Page /Parent 2 0 R /Contents %d 0 R >>' % num)
+        return num+1
+    write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    writeobj(3, b'<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>')
+    kids, rows, page = [], [], opt.get('firstpage') or 1
+    for row in nativerows(layout, inputfiles):
+        rows.append(row)
+        if len(rows) == perpage:
+            kids.append(writepage(rows, page, row[0]))
+            rows, page = [], page+1
+    if rows or not kids:
+        kids.append(writepage(rows, page, rows[-1][0] if rows else 0))
+    writeobj(2, b'<< /Type /Pages /Count %d /Kids [%s] /MediaBox [0 0 %.2f %.2f]'
+                b' /Resources << /Font << /F1 3 0 R >> >> >>'
+                % (len(kids), b' '.join(b'%d 0 R' % k for k in kids), layout['pagesize'][0],
+                   layout['pagesize'][1]))
+    writeobj(1, b'<< /Type /Catalog /Pages 2 0 R >>')
+    xref = written[0]
+    write(b'xref\n0 %d\n0000000000 65535 f \n' % len(offsets))
+    write(b''.join(b'%010d 00000 n \n' % offset for offset in offsets[1:]))
+    write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(offsets), xref))
+    logging.debug('Native backend wrote %d pages' % len(kids))
+    return len(kids)
+
+def nativejob(args, options, inputfiles, output, workdir, stats=None):
+    '''Render plain text input files with the native backend. Input files are
+    staged into `workdir` only if read through a filter, from stdin, or in
+    ranges
+
+    Raises:
+        RuntimeError: if input cannot be read or needs LaTeX
+    '''
+    for f in inputfiles:
+        if mintedlang(options, f) not in ['text', 'txt']:
+            raise RuntimeError('The native backend prints plain text only, not %s'
+                               % mintedlang(options, f))
+    if args.filter or '-' in inputfiles or options.get('ranges'):
+        files = ["source%d%s"%(i, os.path.splitext(f)[-1]) for i,f in enumerate(inputfiles)]
+        with timed(stats, 'stage'):
+            stageinputs(inputfiles, files, workdir, args.filter, args.filter_stdin, stats,
+                        options.get('ranges'))
+        inputfiles = [os.path.join(workdir, f) for f in files]
+    with timed(stats, 'native'):
+        with openoutput(output) as fp:
+            nativepdf(options, inputfiles, fp, stats)
+
+def preparejob(args, options, inputfiles, output, workdir, jobs=None, pool=None, stats=None):
+    '''First part of renderjob(): stage the input files into `workdir`, look
+    up the output cache, and prepare the document for xelatex. It does not
+    change the working directory, hence jobs can run in parallel threads
+
+    Args:
+        args: argparse namespace object
+        options (dict): output of latexoptions() for this job
+        inputfiles (list of str): path to input files, or `-` for stdin
+        output (str): path to output PDF, or `-` for stdout
+        workdir (str): the working directory
+        jobs (int): number of worker processes for highlighting
+        pool (concurrent.futures.Executor): long-lived pool for highlighting
+        stats (dict): to collect run statistics, see runcommand()
+
+    Returns:
+        dict: with keys `latexcode`, `commandline`, `pdfcache` and `key`, to
+        run xelatex and then call finishjob(), or None if the output is
+        delivered from the cache
+
+    Raises:
+        RuntimeError: if input cannot be read
+    '''
+    for path in inputfiles:
+        if path != '-' and not os.path.isfile(path):
+            raise RuntimeError('Cannot read file %s' % os.path.abspath(path))
+    if options.get('backend') == 'native':
+        nativejob(args, options, inputfiles, output, workdir, stats)
+        return None
+    files = ["source%d%s"%(i, os.path.splitext(f)[-1]) for i,f in enumerate(inputfiles)]
+    with timed(stats, 'buildlatex'):
+        latexcode = buildlatex(options, files)
+    with timed(stats, 'stage'):
+        staged = stageinputs(inputfiles, files, workdir, args.filter, args.filter_stdin, stats,
+                             options.get('ranges'))
+    if stats is not None:
+        with STATSLOCK:
+            total = stats.setdefault('staged', dict.fromkeys(staged, 0))
+            for method, size in staged.items():
+                total[method] += size
+    pdfcache = key = None
+    if not args.no_cache:
+        # key from staged files, which are the filter output or stdin data
+        with timed(stats, 'cache'):
+            pdfcache = cachedir('pdf', args.cache_dir)
+            key = cachekey([os.path.join(workdir, f) for f in files], options, latexcode)
+            if pdfcachehit(pdfcache, key, output, stats):
+                return None
+    commandline = preparedocument(args, options, latexcode, inputfiles, files, workdir, jobs, pool,
+                                  stats)
+    return {'latexcode':latexcode, 'commandline':commandline, 'pdfcache':pdfcache, 'key':key}
+
+def finishjob(args, job, passes, output, workdir, stats=None):
+    '''Last part of renderjob() after xelatex: deliver the PDF to `output`
+    and store it in the output cache
+
+    Args:
+        args: argparse namespace object
+        job (dict): output of preparejob()
+        passes (int): number of xelatex passes run
+        output (str): path to output PDF, or `-` for stdout
+        workdir (str): the working directory
+        stats (dict): to collect run statistics, see runcommand()
+
+    Raises:
+        RuntimeError: if no PDF is produced
+    '''
+    pdffile = documentresult(workdir, passes, stats)
+    logging.debug('Output to %s' % output)
+    with timed(stats, 'output'):
+        writeoutput(pdffile, output)
+        if job['pdfcache']:
+            cachestore(job['pdfcache'], job['key'], '.pdf', pdffile, int(args.cache_size*(1<<20)))
+
+def renderjob(args, options, inputfiles, output, jobs=None, pool=None, stats=None, workdir=None):
+    '''Render input files into one PDF in a temp dir, or in `workdir` if
+    given. It does not change the working directory, hence jobs can run in
+    parallel threads
+
+    Args:
+        args: argparse namespace object
+        options (dict): output of latexoptions() for this job
+        inputfiles (list of str): path to input files, or `-` for stdin
+        output (str): path to output PDF, or `-` for stdout
+        jobs (int): number of worker processes for highlighting
+        pool (concurrent.futures.Executor): long-lived pool for highlighting
+        stats (dict): to collect run statistics, see runcommand()
+        workdir (str): an empty directory owned by the caller to compile in,
+                       e.g. a work directory of the daemon, instead of one
+                       from jobworkdir()
+
+    Raises:
+        RuntimeError: if input cannot be read or no PDF is produced
+        subprocess.CalledProcessError: if xelatex failed
+    '''
+    if workdir is None:
+        with jobworkdir(args, options) as workdir:
+            renderjob(args, options, inputfiles, output, jobs, pool, stats, workdir)
+        return
+    job = preparejob(args, options, inputfiles, output, workdir, jobs, pool, stats)
+    if job is None:
+        return
+    with timed(stats, 'xelatex'):
+        passes = runlatex(job['commandline'], job['latexcode'],
+                          os.path.join(workdir, TEXFILE[:-3] + 'aux'), cwd=workdir, stats=stats,
+                          driver=pdfcommand(options, TEXFILE, args.quiet))
+    finishjob(args, job, passes, output, workdir, stats)
+
+def pdfcachehit(pdfcache, key, output, stats=None):
+    '''Deliver the PDF from the output cache if it is there. Hit or miss is
+    counted into `stats['pdfcache']` if stats is not None
+
+    Returns:
+        bool: whether the cache hit and the output is written
+    '''
+    cached = cachelookup(pdfcache, key, '.pdf')
+    try:
+        if cached:
+            writeoutput(cached, output)
+            logging.info('PDF cache hit: %s' % key)
+            logging.debug('Output to %s' % output)
+            if stats is not None:
+                with STATSLOCK:
+                    stats.setdefault('pdfcache', []).append('hit')
+            return True
+    except (IOError, OSError):
+        pass # evicted by a concurrent process, treat as a miss
+    logging.info('PDF cache miss: %s' % key)
+    if stats is not None:
+        with STATSLOCK:
+            stats.setdefault('pdfcache', []).append('miss')
+    return False
+
+TEXFILE = 'mintscript_temp.tex' # the generated document in the working directory
+
+def preparedocument(args, options, latexcode, inputfiles, files, workdir, jobs=None, pool=None,
+                    stats=None):
+    '''Prepare the LaTeX document in a working directory with staged input
+    files: write it, highlight the files if pygments is used, and load the
+    precompiled format if requested
+
+    Args:
+        args: argparse namespace object
+        options (dict): output of latexoptions() for this job
+        latexcode (str): output of buildlatex()
+        inputfiles (list of str): original input file names
+        files (list of str): staged file names in the working directory
+        workdir (str): the working directory
+        jobs (int): number of worker processes for highlighting
+        pool (concurrent.futures.Executor): long-lived pool for highlighting
+        stats (dict): to collect run statistics, see runcommand()
+
+    Returns:
+        list: xelatex command line to run in `workdir`
+    '''
+    assert(TEXFILE not in files)
+    with open(os.path.join(workdir, TEXFILE),'w') as fp:
+        fp.write(latexcode)
+    logging.debug('LaTeX code:\n%s' % latexcode)
+    if options['highlighter'] == 'pygments':
+        with timed(stats, 'highlight'):
+            hlcache = None if args.no_cache else cachedir('highlight', args.cache_dir)
+            highlightinputs(options, inputfiles, files, jobs,
+                            hlcache, int(args.cache_size*(1<<20)), workdir, pool)
+    commandline = latexcommand(options, TEXFILE, args.quiet)
+    if args.precompile:
+        with timed(stats, 'format'):
+            fmtname = latexformat(latexcode, TEXFILE, cachedir('formats', args.cache_dir),
+                                  int(args.cache_size*(1<<20)), '-shell-escape' in commandline,
+                                  workdir, stats)
+        if fmtname:
+            commandline.insert(1, '-fmt=%s' % fmtname)
+    return commandline
+
+def documentresult(workdir, passes, stats=None, ext='pdf'):
+    '''Locate the PDF compiled in `workdir`, or the XDV file if `ext` is
+    `xdv`. The xelatex log statistics of the document are appended to
+    `stats['documents']` if stats is not None
+
+    Returns:
+        str: path to the PDF produced
+
+    Raises:
+        RuntimeError: if no PDF is produced
+    '''
+    pdffile = os.path.join(workdir, TEXFILE[:-3] + ext)
+    if not os.path.isfile(pdffile):
+        raise RuntimeError('xelatex completed but %s not found in output' % pdffile)
+    if stats is not None:
+        docstats = dict(parselatexlog(pdffile[:-3] + 'log'), passes=passes)
+        with STATSLOCK:
+            stats.setdefault('documents', []).append(docstats)
+    return pdffile
+
+def compiledocument(args, options, latexcode, inputfiles, files, workdir, jobs=None, pool=None,
+                    stats=None, pdf=True):
+    '''Compile the LaTeX document in a working directory with staged input
+    files: preparedocument() and run xelatex
+
+    Args:
+        as preparedocument()
+        pdf (bool): whether to run the PDF driver, or stop at the XDV file of
+                    the last pass, e.g. to count pages only
+
+    Returns:
+        str: path to the PDF produced, or to the XDV file if `pdf` is False
+    '''
+    commandline = preparedocument(args, options, latexcode, inputfiles, files, workdir, jobs, pool,
+                                  stats)
+    with timed(stats, 'xelatex'):
+        passes = runlatex(commandline, latexcode, os.path.join(workdir, TEXFILE[:-3] + 'aux'),
+                          cwd=workdir, stats=stats,
+                          driver=pdfcommand(options, TEXFILE, args.quiet) if pdf else None)
+    return documentresult(workdir, passes, stats, 'pdf' if pdf else 'xdv')
+
+def pagecount(pdffile):
+    '''Number of pages of a PDF or XDV file made by xelatex, read from its log
+    file
+    '''
+    pages = parselatexlog(os.path.splitext(pdffile)[0] + '.log')['pages']
+    if pages is None:
+        raise RuntimeError('Cannot find page count of %s' % pdffile)
+    return pages
+
+def splitinput(path, workdir, nlines):
+    '''Split a file into chunks of `nlines` lines. Each chunk is written into
+    its own sub-directory of `workdir` with the same file name
+
+    Returns:
+        list of tuple: directory of the chunk and the zero-based line number of
+        its first line
+    '''
+    name = os.path.basename(path)
+    chunks, fp = [], None
+    with open(path, 'rb') as src:
+        for i, line in enumerate(src):
+            if i % nlines == 0:
+                if fp:
+                    fp.close()
+                chunkdir = os.path.join(workdir, 'shard%d' % len(chunks))
+                os.mkdir(chunkdir)
+                fp = open(os.path.join(chunkdir, name), 'wb')
+                chunks.append((chunkdir, i))
+            fp.write(line)
+    if fp:
+        fp.close()
+    else: # empty input, still make one page
+        chunkdir = os.path.join(workdir, 'shard0')
+        os.mkdir(chunkdir)
+        open(os.path.join(chunkdir, name), 'wb').close()
+        chunks.append((chunkdir, 0))
+    return chunks
+
+def shardoptions(options, firstline, firstpage=None, lastpage=None):
+    '''Options for a chunk of a sharded job: line numbers continue from the
+    preceding chunks by `firstnumber`, and page numbers by `firstpage`
+    '''
+    minted = [o for o in options['minted'] if not o.startswith('firstnumber=')]
+    if 'linenos' in minted:
+        minted.append('firstnumber=%d' % (firstnumber(options['minted']) + firstline))
+    return dict(options, minted=minted, firstpage=firstpage, lastpage=lastpage)
+
+def mergepdfs(pdffiles, outfile, workdir, quiet=False, stats=None):
+    '''Concatenate PDF files using qpdf or pdfunite if available, otherwise
+    with xelatex and the pdfpages package
+    '''
+    if shutil.which('qpdf'):
+        commandline = ['qpdf','--empty','--pages'] + pdffiles + ['--', outfile]
+    elif shutil.which('pdfunite'):
+        commandline = ['pdfunite'] + pdffiles + [outfile]
+    else:
+        texfile = os.path.join(workdir, 'mintscript_merge.tex')
+        with open(texfile, 'w') as fp:
+            fp.write('\n'.join([r'\documentclass{article}', r'\usepackage{pdfpages}'
+                                ,r'\begin{document}']
+                               +[r'\includepdf[pages=-,fitpaper]{%s}' % os.path.relpath(f, workdir)
+                                 for f in pdffiles]
+                               +[r'\end{document}']))
+        commandline = ['xelatex','-interaction=%s' % ('batchmode' if quiet else 'nonstopmode'),
+                       '-halt-on-error', os.path.basename(texfile)]
+        status = runcommand(commandline, stats, cwd=workdir)
+        if status != 0:
+            raise subprocess.CalledProcessError(status, commandline)
+        os.rename(texfile[:-3] + 'pdf', outfile)
+        return
+    status = runcommand(commandline, stats)
+    if status != 0:
+        raise subprocess.CalledProcessError(status, commandline)
+
+def shardjob(args, options, inputfile, output, jobs=None, stats=None):
+    '''Render one large input file by splitting it into chunks of
+    `args.shard_lines` lines, compiling the chunks in parallel, and merging the
+    chunk PDFs. If the header or footer shows page numbers, the chunks are
+    compiled once to count their pages, then again with the page offset and
+    the total number of pages
+
+    Args:
+        args: argparse namespace object
+        options (dict): output of latexoptions() for this job
+        inputfile (str): path to the input file, or `-` for stdin
+        output (str): path to output PDF, or `-` for stdout
+        jobs (int): number of chunks to compile in parallel
+        stats (dict): to collect run statistics, see runcommand()
+    '''
+    if inputfile != '-' and not os.path.isfile(inputfile):
+        raise RuntimeError('Cannot read file %s' % os.path.abspath(inputfile))
+    staged = 'source0%s' % os.path.splitext(inputfile)[-1]
+    headfoot = json.dumps([options['header'], options['footer']])
+    needpages = r'\thepage' in headfoot or r'\pageref{LastPage}' in headfoot
+    with jobworkdir(args) as workdir:
+        with timed(stats, 'stage'):
+            stageinputs([inputfile], [staged], workdir, args.filter, args.filter_stdin, stats)
+        pdfcache = key = None
+        if not args.no_cache:
+            with timed(stats, 'cache'):
+                pdfcache = cachedir('pdf', args.cache_dir)
+                key = cachekey([os.path.join(workdir, staged)], dict(options, shard=args.shard_lines),
+                               buildlatex(options, [staged]))
+                if pdfcachehit(pdfcache, key, output, stats):
+                    return
+        with timed(stats, 'split'):
+            chunks = splitinput(os.path.join(workdir, staged), workdir, args.shard_lines)
+        logging.debug('Split %s into %d chunks' % (inputfile, len(chunks)))
+        def compilechunk(chunk, opt, pdf=True):
+            chunkdir, _ = chunk
+            return compiledocument(args, opt, buildlatex(opt, [staged]), [inputfile], [staged],
+                                   chunkdir, jobs=1, stats=stats, pdf=pdf)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as pool:
+            firstpages, total = [None]*len(chunks), None
+            if needpages: # first round to count pages of each chunk, from the XDV pass
+                xdvfiles = list(pool.map(lambda c: compilechunk(c, shardoptions(options, c[1], lastpage=0),
+                                                                pdf=False),
+                                         chunks))
+                pages = [pagecount(f) for f in xdvfiles]
+                firstpages = [1+sum(pages[:i]) for i in range(len(pages))]
+                total = sum(pages)
+            pdffiles = list(pool.map(lambda c, p: compilechunk(c, shardoptions(options, c[1], p, total)),
+                                     chunks, firstpages))
+        pdffile = os.path.join(workdir, 'merged.pdf')
+        with timed(stats, 'merge'):
+            mergepdfs(pdffiles, pdffile, workdir, args.quiet, stats)
+        logging.debug('Output to %s' % output)
+        with timed(stats, 'output'):
+            writeoutput(pdffile, output)
+            if pdfcache:
+                cachestore(pdfcache, key, '.pdf', pdffile, int(args.cache_size*(1<<20)))
+
+def batch(args, stats=None):
+    '''Batch mode: render each input file into its own PDF, on a pool of
+    `args.jobs` workers. Larger files are scheduled first, and a failed job does
+    not stop the others
+
+    Returns:
+        int: exit status, nonzero if any job failed
+    '''
+    inputfiles = list(args.file)
+    if args.manifest:
+        with open(args.manifest) as fp:
+            inputfiles.extend(line.strip() for line in fp
+                              if line.strip() and not line.lstrip().startswith('#'))
+    if not inputfiles:
+        logging.error('No input file for batch mode')
+        return 1
+    if args.output == '-':
+        logging.error('Batch mode cannot write to stdout')
+        return 1
+    def filesize(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return -1 # fail later in renderjob
+    inputfiles.sort(key=filesize, reverse=True) # largest first
+    outputof, writers = {}, {}
+    for path in inputfiles:
+        output = os.path.splitext(path)[0] + '.pdf'
+        if args.output:
+            output = os.path.join(args.output, os.path.basename(output))
+        outputof[path] = output
+        writers.setdefault(os.path.abspath(output), []).append(path)
+    clashes = [paths for paths in writers.values() if len(paths) > 1]
+    if clashes:
+        for paths in clashes:
+            logging.error('Batch inputs %s would write the same PDF' % ', '.join(paths))
+        return 1
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+    args = argparse.Namespace(**dict(vars(args), file=inputfiles)) # do not modify the caller's
+    try:
+        with timed(stats, 'latexoptions'):
+            options = latexoptions(args) # once for the whole batch
+    except RuntimeError as e:
+        logging.error(str(e))
+        return 1
+    logging.debug(options)
+    def job(path):
+        start = time.time()
+        jobstats = {} if stats is not None else None # per job, as jobs overlap in time
+        try:
+            parts, ranges = [path], None
+            if args.lines is not None or args.bytes is not None:
+                parts, ranges = selectranges(argparse.Namespace(**dict(vars(args), file=[path])))
+            opt = dict(options, input=parts, ranges=ranges)
+            opt.update(headeroptions(args, parts))
+            renderjob(args, opt, parts, outputof[path], jobs=1, stats=jobstats)
+        finally:
+            if stats is not None:
+                with STATSLOCK:
+                    stats.setdefault('jobs', []).append(dict(jobstats, input=path,
+                                                             seconds=time.time()-start))
+        return outputof[path], time.time()-start
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs or os.cpu_count() or 1) as pool:
+        futures = [(path, pool.submit(job, path)) for path in inputfiles]
+        for path, future in futures:
+            try:
+                output, elapsed = future.result()
+                results.append(('ok', path, '%s (%.2fs)' % (output, elapsed)))
+            except subprocess.CalledProcessError as e:
+                results.append(('failed', path, 'xelatex failed with return code %s' % e.returncode))
+            except Exception as e:
+                results.append(('failed', path, str(e)))
+    failed = sum(1 for status,_,_ in results if status != 'ok')
+    if not args.quiet:
+        for status, path, message in results:
+            print('%-6s %s: %s' % (status, path, message), file=sys.stderr)
+        print('%d job(s), %d failed' % (len(results), failed), file=sys.stderr)
+    return 1 if failed else 0
+
+# inotify event mask of changes to a file in a watched directory, from
+# linux/inotify.h: IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE
+INOTIFYMASK = 0x002 | 0x004 | 0x008 | 0x080 | 0x100
+
+def inotifywaiter(paths):
+    '''Wait for changes of files by inotify on their directories, to catch
+    editors that save by renaming a new file over the old one
+
+    Returns:
+        tuple: function that blocks until a change, and function that closes
+        the inotify descriptor; or None if inotify is not available
+    '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    for dirpath in set(os.path.dirname(os.path.abspath(p)) for p in paths):
+        if libc.inotify_add_watch(fd, os.fsencode(dirpath), INOTIFYMASK) < 0:
+            os.close(fd)
+            return None
+    def wait():
+        select.select([fd], [], [])
+        while select.select([fd], [], [], 0.05)[0]: # coalesce a burst of events
+            os.read(fd, 1<<16)
+    return wait, lambda: os.close(fd)
+
+def filesignature(path):
+    '''Identity and version of a file to detect changes, or None if missing
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+def rerender(args, options, files, changed, workdir, state, stats=None):
+    '''One render of watch mode in the kept work directory `workdir`
+
+    Args:
+        args: argparse namespace object
+        options (dict): output of latexoptions() for this job
+        files (list of str): staged file names in the working directory
+        changed (list of int): indices of the input files changed since the
+                               last render, which are staged again
+        workdir (str): the working directory
+        state (dict): the preamble and xelatex command line of the last
+                      render, which are reused while the preamble is unchanged
+        stats (dict): to collect run statistics, see runcommand()
+    '''
+    inputfiles = args.file
+    for i in changed:
+        if os.path.lexists(os.path.join(workdir, files[i])):
+            os.unlink(os.path.join(workdir, files[i]))
+    with timed(stats, 'stage'):
+        stageinputs([inputfiles[i] for i in changed], [files[i] for i in changed], workdir,
+                    args.filter, args.filter_stdin, stats)
+    options.update(headeroptions(args, inputfiles)) # names and times in header
+    if options['backend'] == 'native':
+        renderjob(args, options, inputfiles, args.output, args.jobs, stats=stats)
+        return
+    with timed(stats, 'buildlatex'):
+        latexcode = buildlatex(options, files)
+    with open(os.path.join(workdir, TEXFILE),'w') as fp:
+        fp.write(latexcode)
+    maxbytes = int(args.cache_size*(1<<20))
+    if options['highlighter'] == 'pygments':
+        with timed(stats, 'highlight'):
+            hlcache = None if args.no_cache else cachedir('highlight', args.cache_dir)
+            highlightinputs(options, [inputfiles[i] for i in changed], [files[i] for i in changed],
+                            args.jobs, hlcache, maxbytes, workdir)
+    preamble = latexcode.split(ENDOFDUMP)[0]
+    if state.get('preamble') != preamble:
+        commandline = latexcommand(options, TEXFILE, args.quiet)
+        if args.precompile:
+            with timed(stats, 'format'):
+                fmtname = latexformat(latexcode, TEXFILE, cachedir('formats', args.cache_dir),
+                                      maxbytes, '-shell-escape' in commandline, workdir, stats)
+            if fmtname:
+                commandline.insert(1, '-fmt=%s' % fmtname)
+        state.update(preamble=preamble, commandline=commandline)
+    with timed(stats, 'xelatex'):
+        try:
+            passes = runlatex(state['commandline'], latexcode,
+                              os.path.join(workdir, TEXFILE[:-3] + 'aux'), cwd=workdir, stats=stats,
+                              driver=pdfcommand(options, TEXFILE, args.quiet))
+        except subprocess.CalledProcessError:
+            state.clear() # the format may be dumped from a broken preamble
+            raise
+    pdffile = documentresult(workdir, passes, stats)
+    with timed(stats, 'output'):
+        writeoutput(pdffile, args.output)
+
+def watch(args, options, stats=None):
+    '''Watch mode: render the input files, then render again whenever they
+    change, until interrupted. The work directory is kept across renders: only
+    changed files are staged again and, with pygments, highlighted again;
+    minted reuses its cache for unchanged code, and xelatex starts from the
+    last aux file, hence runs a second pass only if page references moved
+
+    Args:
+        args: argparse namespace object
+        options (dict): output of latexoptions() for this job
+        stats (dict): to collect run statistics, see runcommand()
+    '''
+    inputfiles = args.file
+    if '-' in inputfiles or args.output == '-':
+        raise RuntimeError('Watch mode needs input and output files, not stdin or stdout')
+    files = ["source%d%s"%(i, os.path.splitext(f)[-1]) for i,f in enumerate(inputfiles)]
+    waiter = inotifywaiter(inputfiles)
+    if waiter is None:
+        logging.info('inotify not available, poll every %g s' % args.watch_interval)
+        waiter = (lambda: time.sleep(args.watch_interval), lambda: None)
+    wait, close = waiter
+    signatures, state = [None]*len(inputfiles), {}
+    with tempdir(chdir=False, root=args.workdir_root) as workdir:
+        try:
+            while True:
+                current = [filesignature(f) for f in inputfiles]
+                changed = [i for i,s in enumerate(current) if s != signatures[i]]
+                if None in current:
+                    logging.warning('Missing input %s, wait for it'
+                                    % ', '.join(f for f,s in zip(inputfiles, current) if s is None))
+                elif changed:
+                    signatures = current
+                    logging.info('Render %s' % ', '.join(inputfiles[i] for i in changed))
+                    start = time.time()
+                    try:
+                        rerender(args, options, files, changed, workdir, state, stats)
+                        logging.info('Wrote %s in %.2fs' % (args.output, time.time()-start))
+                    except subprocess.CalledProcessError as e:
+                        logging.error('xelatex failed with return code %s' % e.returncode)
+                    except RuntimeError as e:
+                        logging.error(str(e))
+                wait()
+        except KeyboardInterrupt:
+            logging.info('Stop watching')
+        finally:
+            close()
+
+def copystream(src, dst, size, bufsize=CHUNKSIZE):
+    '''Copy exactly `size` bytes from file object `src` to `dst` in chunks
+    '''
+    while size > 0:
+        block = src.read(min(bufsize, size))
+        if not block:
+            raise IOError('Unexpected end of stream, %d bytes missing' % size)
+        dst.write(block)
+        size -= len(block)
+
+class RenderServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''Render daemon accepting jobs over a Unix domain socket. State is kept
+    warm between jobs: tool versions are memoized, pygments is imported, the
+    highlighting worker pool is alive and work directories are created ahead
+
+    A job is a JSON line of {"args": vars of argparse namespace, "files": list
+    of {"name", "size", "mtime"}, "cwd", "environ"}, followed by the content of
+    the files. The reply is a JSON line of {"status", "error", "size"} followed
+    by the PDF. `cwd` and `environ` of the client, limited to the variables
+    used in header and footer, are for the `%c`, `%d` and `$(VAR)` escapes
+    '''
+    daemon_threads = True
+
+    def __init__(self, path, args):
+        self.args = args
+        jobs = args.jobs or os.cpu_count() or 1
+        self.slots = threading.BoundedSemaphore(jobs)
+        self.workdirs = queue.Queue()
+        for _ in range(jobs):
+            self.workdirs.put(tempfile.mkdtemp(prefix='mintscript-', dir=args.workdir_root))
+        self.pool = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+        toolversions()
+        try:
+            latexoptions(args) # resolve the fonts of the server's options ahead of jobs
+        except Exception as e:
+            logging.warning('Cannot resolve fonts ahead of jobs: %s' % e)
+        try:
+            import pygments.formatters, pygments.lexers
+        except ImportError:
+            pass
+        socketserver.UnixStreamServer.__init__(self, path, RenderHandler)
+        os.chmod(path, 0o600)
+
+    def recycle(self, workdir):
+        '''Empty a work directory in background and make it available again'''
+        def cleanup():
+            emptydir(workdir)
+            self.workdirs.put(workdir)
+        threading.Thread(target=cleanup, daemon=True).start()
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self.pool.shutdown()
+        while not self.workdirs.empty():
+            shutil.rmtree(self.workdirs.get(), ignore_errors=True)
+
+class RenderHandler(socketserver.StreamRequestHandler):
+    '''Handle one job sent by sendjob()'''
+    def handle(self):
+        server = self.server
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        workdir = server.workdirs.get()
+        try:
+            output = os.path.join(workdir, 'output.pdf')
+            status, error = 0, None
+            try:
+                inputfiles = []
+                for i, f in enumerate(request['files']):
+                    path = os.path.join(workdir, 'input%d' % i, os.path.basename(f['name']))
+                    os.mkdir(os.path.dirname(path))
+                    with open(path, 'wb') as fp:
+                        copystream(self.rfile, fp, f['size'])
+                    os.utime(path, (f['mtime'], f['mtime'])) # for time fields in header
+                    inputfiles.append(path)
+                args = argparse.Namespace(**request['args'])
+                args.file, args.output = inputfiles, output
+                args.origin = {'cwd':request.get('cwd'), 'environ':request.get('environ')}
+                for name in ['no_cache', 'cache_dir', 'cache_size', 'precompile', 'workdir_root',
+                             'workdir_pool', 'workdir_cleanup']:
+                    setattr(args, name, getattr(server.args, name)) # server controls caches
+                options = latexoptions(args)
+                # print the file names of the client, not the paths in workdir
+                names = ['stdin' if f['name'] == '-' else f['name'] for f in request['files']]
+                options.update(headeroptions(args, inputfiles, names))
+                with server.slots:
+                    renderjob(args, options, inputfiles, output, pool=server.pool, workdir=workdir)
+            except subprocess.CalledProcessError as e:
+                status, error = e.returncode, 'xelatex failed with return code %s' % e.returncode
+            except SystemExit as e:
+                status, error = e.code or 1, 'invalid job arguments'
+            except Exception as e:
+                logging.exception('Job failed')
+                status, error = 1, str(e) or repr(e)
+            size = os.path.getsize(output) if status == 0 else 0
+            reply = {'status':status, 'error':error, 'size':size}
+            try:
+                self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+                if size:
+                    with open(output, 'rb') as fp:
+                        copystream(fp, self.wfile, size)
+            except OSError as e: # client went away
+                logging.warning('Cannot send the result to the client: %s' % e)
+        finally:
+            server.recycle(workdir)
+
+def serve(args):
+    '''Run the render daemon until interrupted'''
+    if os.path.exists(args.serve):
+        os.unlink(args.serve) # stale socket from previous run
+    server = RenderServer(args.serve, args)
+    logging.info('Serving at %s' % args.serve)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.serve)
+
+def sendjob(args):
+    '''Thin client: send the input files and options to the render daemon
+    and write the returned PDF to the output
+
+    Returns:
+        int: exit status of the job
+    '''
+    options = {k:v for k,v in vars(args).items() if k not in ['file','output','client','serve']}
+    paths = list(args.file)
+    if '-' in paths: # the protocol needs the size ahead, spool stdin first
+        spool = tempfile.TemporaryFile()
+        shutil.copyfileobj(sys.stdin.buffer, spool, CHUNKSIZE)
+        spool.seek(0)
+    files = [{'name':path, 'size':os.fstat(spool.fileno()).st_size if path == '-' else os.path.getsize(path)
+             ,'mtime':time.time() if path == '-' else os.stat(path).st_mtime}
+             for path in paths]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(args.client)
+    except OSError as e: # no daemon listening
+        sock.close()
+        logging.error('Cannot connect to render daemon at %s: %s' % (args.client, e.strerror or e))
+        return 1
+    with sock, sock.makefile('rb') as rfile, sock.makefile('wb') as wfile:
+        request = {'args':options, 'files':files, 'cwd':os.getcwd(), 'environ':formatenviron([args.header, args.footer])}
+        wfile.write((json.dumps(request) + '\n').encode('utf-8'))
+        for f in files:
+            if f['name'] == '-':
+                copystream(spool, wfile, f['size'])
+                continue
+            with open(f['name'], 'rb') as fp:
+                copystream(fp, wfile, f['size'])
+        wfile.flush()
+        reply = json.loads(rfile.readline().decode('utf-8'))
+        if reply['status'] != 0:
+            logging.error(reply['error'])
+            return reply['status']
         logging.debug('Output to %s' % args.output)
         if args.output == '-':
-            sys.stdout.buffer.write(open(pdffile).read()) # dump binary to stdout
-        elif args.output:
-            shutil.copyfile(pdffile, os.path.join(cwd,args.output))
+            copystream(rfile, sys.stdout.buffer, reply['size'])
+        else:
+            with open(args.output, 'wb') as fp:
+                copystream(rfile, fp, reply['size'])
+    return 0
+
+def spoolsources(sources, workdir):
+    '''Write in-memory sources of render() as files in `workdir`
+
+    Args:
+        sources: list of file paths, bytes, file-like objects opened in binary
+                 mode, or (name, bytes or file-like) tuples to name the source
+                 for headers and language detection
+        workdir (str): directory to write the files
+
+    Returns:
+        tuple: list of paths to the input files, and list of their names
+    '''
+    if isinstance(sources, (str, bytes, os.PathLike, tuple)) or hasattr(sources, 'read'):
+        sources = [sources]
+    inputfiles, names = [], []
+    for i, source in enumerate(sources):
+        name = None
+        if isinstance(source, tuple):
+            name, source = source
+        if isinstance(source, (str, os.PathLike)):
+            inputfiles.append(os.fspath(source))
+            names.append(name)
+            continue
+        if name is None:
+            name = getattr(source, 'name', None)
+            name = name if isinstance(name, str) else 'source%d' % (i+1)
+        path = os.path.join(workdir, 'input%d' % i, os.path.basename(name))
+        os.mkdir(os.path.dirname(path))
+        with open(path, 'wb') as fp:
+            if isinstance(source, bytes):
+                fp.write(source)
+            else:
+                shutil.copyfileobj(source, fp, CHUNKSIZE)
+        inputfiles.append(path)
+        names.append(name)
+    return inputfiles, names
+
+def apijob(sources, options, workdir):
+    '''Arguments, LaTeX options and input files of a render() job. Unlike
+    the command line, the persistent caches are off unless `no_cache=False`
+
+    Returns:
+        tuple: argparse namespace object, dict of options, list of input files
+
+    Raises:
+        RuntimeError: if input cannot be read
+    '''
+    options.setdefault('quiet', True)
+    options.setdefault('no_cache', True)
+    args = jobargs(**options)
+    inputfiles, names = spoolsources(sources, workdir)
+    if not inputfiles:
+        raise RuntimeError('No source to render')
+    for path in inputfiles:
+        if not os.path.isfile(path):
+            raise RuntimeError('Cannot read file %s' % os.path.abspath(path))
+    args.file, ranges = inputfiles, None
+    if args.lines is not None or args.bytes is not None:
+        names = dict(zip(inputfiles, names))
+        args.file, ranges = selectranges(args)
+        inputfiles, names = args.file, [names[f] for f in args.file]
+    opt = latexoptions(args)
+    opt['ranges'] = ranges
+    opt.update(headeroptions(args, inputfiles,
+                             [n or f for n, f in zip(names, inputfiles)]))
+    return args, opt, inputfiles
+
+def render(sources, **options):
+    '''Render sources into PDF, for use as a library. Temp files are removed
+    before return
+
+    Args:
+        sources: a source or list of sources, each a file path, bytes, a
+                 file-like object in binary mode, or a (name, bytes or
+                 file-like) tuple, see spoolsources()
+        options: as jobargs(), e.g. `columns=2, highlighter='pygments'`. xelatex
+                 runs in batch mode unless `quiet=False`, and the persistent
+                 caches are used only with `no_cache=False`
+
+    Returns:
+        bytes: the PDF
+
+    Raises:
+        TypeError: if an option is unknown
+        ValueError: if the value of an option is invalid
+        RuntimeError: if input cannot be read or no PDF is produced
+        subprocess.CalledProcessError: if xelatex failed
+    '''
+    with tempdir(chdir=False, root=options.get('workdir_root')) as workdir:
+        args, opt, inputfiles = apijob(sources, options, workdir)
+        output = os.path.join(workdir, 'output.pdf')
+        renderjob(args, opt, inputfiles, output)
+        with open(output, 'rb') as fp:
+            return fp.read()
+
+RENDERSLOTS = weakref.WeakKeyDictionary() # event loop to default semaphore of renderasync()
+
+async def renderasync(sources, semaphore=None, **options):
+    '''Same as render() but a coroutine: xelatex runs by asyncio and other
+    work in the default executor, so that the event loop is not blocked
+
+    Args:
+        sources: as render()
+        semaphore (asyncio.Semaphore): bounds the number of concurrent jobs,
+                                       default allows one job per CPU for each
+                                       event loop
+        options: as render()
+
+    Returns:
+        bytes: the PDF
+    '''
+    loop = asyncio.get_running_loop()
+    if semaphore is None:
+        if loop not in RENDERSLOTS:
+            RENDERSLOTS[loop] = asyncio.Semaphore(os.cpu_count() or 1)
+        semaphore = RENDERSLOTS[loop]
+    async with semaphore:
+        workdir = await loop.run_in_executor(None, tempfile.mkdtemp,
+                                             '', 'tmp', options.get('workdir_root'))
+        try:
+            args, opt, inputfiles = await loop.run_in_executor(
+                None, apijob, sources, dict(options), workdir)
+            output = os.path.join(workdir, 'output.pdf')
+            # checking out and cleaning the work directory may block on flock and rmtree
+            workctx = jobworkdir(args, opt)
+            jobdir = await loop.run_in_executor(None, workctx.__enter__)
+            try:
+                job = await loop.run_in_executor(
+                    None, preparejob, args, opt, inputfiles, output, jobdir)
+                if job is not None:
+                    passes = await runlatexasync(job['commandline'], job['latexcode'],
+                                                 os.path.join(jobdir, TEXFILE[:-3] + 'aux'),
+                                                 cwd=jobdir,
+                                                 driver=pdfcommand(opt, TEXFILE, args.quiet))
+                    await loop.run_in_executor(None, finishjob, args, job, passes, output,
+                                               jobdir)
+            except BaseException:
+                if not await loop.run_in_executor(None, workctx.__exit__, *sys.exc_info()):
+                    raise
+            else:
+                await loop.run_in_executor(None, workctx.__exit__, None, None, None)
+            with open(output, 'rb') as fp:
+                return fp.read()
+        finally:
+            await loop.run_in_executor(None, shutil.rmtree, workdir)
+
+def run(args, stats=None):
+    '''Run the job as specified by the command line arguments
+
+    Returns:
+        int: exit status
+    '''
+    if args.serve:
+        serve(args)
+        return 0
+    if args.shard_lines and args.backend == 'native':
+        logging.error('--shard-lines is not supported by the native backend')
+        return 1
+    if args.lines is not None or args.bytes is not None:
+        if args.lines is not None and args.bytes is not None:
+            logging.error('--lines and --bytes are exclusive')
+            return 1
+        if args.client or args.watch or args.shard_lines:
+            logging.error('Ranges are not supported in client, watch or sharding mode')
+            return 1
+    if args.batch or args.manifest:
+        return batch(args, stats)
+    if len(args.file) < 1:
+        args.file = ['-'] # read from stdin
+    logging.debug(args)
+    if not args.output:
+        args.output = '-' if args.file[0] == '-' else os.path.splitext(args.file[0])[0] + '.pdf'
+    if args.client:
+        return sendjob(args)
+    try:
+        ranges = None
+        if args.lines is not None or args.bytes is not None:
+            with timed(stats, 'lineindex'):
+                args.file, ranges = selectranges(args)
+        with timed(stats, 'latexoptions'):
+            options = latexoptions(args)
+        options['ranges'] = ranges
+        logging.debug(options)
+        if args.watch:
+            watch(args, options, stats)
+        elif args.shard_lines:
+            if len(args.file) != 1:
+                logging.error('Sharding needs exactly one input file')
+                return 1
+            shardjob(args, options, args.file[0], args.output, args.jobs, stats)
+        else:
+            renderjob(args, options, args.file, args.output, args.jobs, stats=stats)
+    except subprocess.CalledProcessError as e:
+        logging.error('xelatex failed with return code %s' % e.returncode)
+        return e.returncode
+    except RuntimeError as e:
+        logging.error(str(e))
+        return 1
+    return 0
+
+def main():
+    start = time.time()
+    args = parseargs()
+    logging.getLogger('').setLevel(logging.ERROR if args.quiet else logging.DEBUG)
+    stats = {'phases':{'parseargs':time.time()-start}} if args.stats_json else None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        status = run(args, stats)
+    finally:
+        if args.profile:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if stats is not None:
+            stats['total'] = time.time() - start
+            with open(args.stats_json, 'w') as fp:
+                json.dump(stats, fp, indent=2, sort_keys=True)
+    sys.exit(status)
 
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s:%(name)s(%(lineno)d):%(levelname)s:%(message)s')